@@ -0,0 +1,683 @@
+# Copyright 2020 Ivan Yelizariev <https://it-projects.info/team/yelizariev>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+"""Replay Telegram and IFTTT events through lambda_handler of the bots.
+
+Telegram Bot API and DynamoDB are replaced by local stand-ins with
+configurable latency, so the report shows time spent by a handler and number
+of round trips it makes. See README.md in this folder.
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOTS = {
+    'todo-bot': os.path.join(ROOT, 'todo-bot', 'lambda_function.py'),
+    'opinions-bot': os.path.join(ROOT, 'opinions-bot', 'lambda_function.py'),
+    'resend-bot': os.path.join(ROOT, 'resend-bot', 'lambda_function.py'),
+    'ifttt-to-telegram': os.path.join(ROOT, 'ifttt-to-telegram', 'lambda_function.py'),
+}
+REPORT_VERSION = 1
+
+BOT_ID = 123456
+BOT_TOKEN = '%s:BENCHMARK' % BOT_ID
+BOT_USER = {'id': BOT_ID, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+TARGET_GROUP = -1001
+# date of the first synthetic message
+START_UNIXTIME = 1600000000
+# Telegram methods that return True rather than a Message
+BOOLEAN_METHODS = ['answerCallbackQuery', 'deleteMessage', 'sendChatAction']
+
+logger = logging.getLogger('benchmark')
+
+
+############
+# Counters #
+############
+
+
+class Recorder(object):
+    """Outbound calls of the current event"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = {'telegram': Counter(), 'db': Counter()}
+
+    def add(self, kind, name):
+        with self.lock:
+            self.calls[kind][name] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict((kind, Counter(calls)) for kind, calls in self.calls.items())
+
+
+recorder = Recorder()
+
+
+class ErrorCounter(logging.Handler):
+    """Counts errors logged by a handler. Some bots log errors instead of raising them"""
+
+    def __init__(self):
+        super(ErrorCounter, self).__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+class FakeContext(object):
+    """Lambda context object"""
+
+    def __init__(self, timeout):
+        self.deadline = time.time() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.time()) * 1000)
+
+
+#############
+# Stand-ins #
+#############
+
+
+class FakeTelegram(object):
+    """Answers Bot API methods without network"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.last_message_id = 0
+        # chat_id -> last message sent by the bot
+        self.last_messages = {}
+
+    def call(self, method, params):
+        recorder.add('telegram', method)
+        time.sleep(self.latency)
+        params = params or {}
+        if method in BOOLEAN_METHODS:
+            return True
+        if method in ['forwardMessages', 'copyMessages']:
+            return [{'message_id': self._next_id()} for _ in json.loads(params['message_ids'])]
+        chat_id = int(params.get('chat_id') or 0)
+        message = {
+            'message_id': int(params.get('message_id') or 0) or self._next_id(),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup', 'title': 'Group'},
+            'from': BOT_USER,
+            'text': str(params.get('text') or ''),
+        }
+        with self.lock:
+            self.last_messages[chat_id] = message
+        return message
+
+    def _next_id(self):
+        with self.lock:
+            self.last_message_id += 1
+            return self.last_message_id
+
+
+def patch_telebot(fake):
+    # https://github.com/eternnoir/pyTelegramBotAPI
+    from telebot import apihelper
+
+    def _make_request(token, method_name, method='get', params=None, files=None):
+        return fake.call(method_name, params)
+    apihelper._make_request = _make_request
+
+
+def patch_python_telegram_bot(fake):
+    # https://github.com/python-telegram-bot/python-telegram-bot
+    from telegram.utils.request import Request
+
+    def post(self, url, data, timeout=None):
+        return fake.call(url.rsplit('/', 1)[-1], data)
+    Request.post = post
+
+
+class CountingStorage(object):
+    """Wraps storage of todo-bot to count requests and add latency"""
+
+    def __init__(self, storage, latency):
+        self.storage = storage
+        self.latency = latency
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+
+        def wrapper(*args, **kwargs):
+            recorder.add('db', name)
+            time.sleep(self.latency)
+            return method(*args, **kwargs)
+        return wrapper
+
+
+def patch_botocore(latency):
+    """Count DynamoDB requests of boto3 and pynamodb. Requests are served by moto"""
+    from botocore.client import BaseClient
+    make_api_call = BaseClient._make_api_call
+
+    def _make_api_call(self, operation_name, api_params):
+        recorder.add('db', operation_name)
+        time.sleep(latency)
+        return make_api_call(self, operation_name, api_params)
+    BaseClient._make_api_call = _make_api_call
+
+
+def start_moto():
+    try:
+        from moto import mock_aws
+    except ImportError:
+        # moto < 5
+        from moto import mock_dynamodb as mock_aws
+    mock = mock_aws()
+    mock.start()
+    return mock
+
+
+##########
+# Events #
+##########
+
+
+class Events(object):
+    """Builds Telegram updates"""
+
+    def __init__(self):
+        self.update_id = 0
+        self.message_id = 100000
+
+    def message(self, user_id, text=None, chat=None, date=None, **extra):
+        self.update_id += 1
+        self.message_id += 1
+        message = {
+            'message_id': self.message_id,
+            'from': self.user(user_id),
+            'chat': chat or {'id': user_id, 'type': 'private', 'first_name': 'User%s' % user_id},
+            'date': date or START_UNIXTIME + self.update_id * 10,
+        }
+        if text is not None:
+            message['text'] = text
+        message.update(extra)
+        return {'update_id': self.update_id, 'message': message}
+
+    def callback(self, user_id, data, message):
+        self.update_id += 1
+        return {'update_id': self.update_id, 'callback_query': {
+            'id': str(self.update_id),
+            'from': self.user(user_id),
+            'chat_instance': '1',
+            'data': data,
+            'message': message,
+        }}
+
+    def user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': 'User%s' % user_id}
+
+
+def webhook(update):
+    """API Gateway event"""
+    return {'body': json.dumps(update)}
+
+
+def cron_event(dt):
+    return {'source': 'aws.events', 'time': dt.strftime('%Y-%m-%dT%H:%M:%SZ')}
+
+
+#############
+# Scenarios #
+#############
+# Scenario is a generator of (event, number_of_updates). Code between yields
+# prepares data and isn't measured.
+
+
+def todo_new_task(bot, args, events):
+    for i in range(args.updates):
+        yield webhook(events.message(todo_user(args, i), 'Task %s' % i)), 1
+
+
+def todo_callback(bot, args, events):
+    user_id = todo_user(args, 0)
+    bot.lambda_handler(webhook(events.message(user_id, 'Task with buttons')), None)
+    task_id = events.update_id - bot.MIN_UPDATE_ID
+    card = {'message_id': 1, 'chat': {'id': user_id, 'type': 'private'}, 'date': START_UNIXTIME}
+    for i in range(args.updates):
+        state = bot.TASK_STATE_DONE if i % 2 == 0 else bot.TASK_STATE_TODO
+        data = bot.encode_callback(bot.ACTION_UPDATE_TASK_STATE, task_id, state)
+        yield webhook(events.callback(user_id, data, card)), 1
+
+
+def todo_callback_shared(bot, args, events):
+    """State of a task is changed by author. The performer is notified"""
+    user_id = todo_user(args, 0)
+    performer_id = todo_user(args, 1)
+    bot.lambda_handler(webhook(events.message(performer_id, '/start')), None)
+    bot.lambda_handler(webhook(events.message(user_id, 'Task for another user')), None)
+    task_id = events.update_id - bot.MIN_UPDATE_ID
+    bot.lambda_handler(webhook(events.message(user_id, '/assign%s' % task_id)), None)
+    bot.lambda_handler(webhook(events.message(user_id, 'User%s u%s' % (performer_id, performer_id))), None)
+    card = {'message_id': 1, 'chat': {'id': user_id, 'type': 'private'}, 'date': START_UNIXTIME}
+    for i in range(args.updates):
+        state = bot.TASK_STATE_DONE if i % 2 == 0 else bot.TASK_STATE_TODO
+        data = bot.encode_callback(bot.ACTION_UPDATE_TASK_STATE, task_id, state)
+        yield webhook(events.callback(user_id, data, card)), 1
+
+
+def todo_mytasks(bot, args, events):
+    user_id = todo_user(args, 0)
+    for i in range(args.tasks):
+        bot.lambda_handler(webhook(events.message(user_id, 'Task %s' % i)), None)
+    for i in range(args.updates):
+        yield webhook(events.message(user_id, '/mytasks')), 1
+
+
+def todo_forward_batch(bot, args, events):
+    """Batches of forwarded messages from SQS queue"""
+    for i in range(args.updates):
+        records = []
+        date = START_UNIXTIME + i * 100
+        for j in range(args.batch_size):
+            user_id = todo_user(args, j % args.users)
+            forward_from = events.user(user_id + 1000)
+            update = events.message(user_id, 'Forwarded %s' % j, date=date, forward_from=forward_from)
+            records.append({'messageId': str(update['update_id']), 'body': json.dumps(update)})
+        yield {'Records': records}, len(records)
+
+
+def todo_cron(bot, args, events):
+    for j in range(args.users):
+        for i in range(args.tasks):
+            bot.lambda_handler(webhook(events.message(todo_user(args, j), 'Task %s' % i)), None)
+    dt = datetime.utcfromtimestamp(events.update_id * 10 + START_UNIXTIME)
+    for i in range(args.updates):
+        # all tasks are due on each run
+        dt += timedelta(days=bot.REMINDER_DAYS + 1)
+        yield cron_event(dt), 1
+
+
+def todo_user(args, i):
+    return 101 + i % args.users
+
+
+def opinions_new_poll(bot, args, events):
+    opinions_create_tables(bot)
+    group = {'id': TARGET_GROUP, 'type': 'supergroup', 'title': 'Group'}
+    for i in range(args.updates):
+        yield webhook(events.message(101, '/new Question %s?' % i, chat=group)), 1
+
+
+def opinions_vote_reply(bot, args, events):
+    poll_message = opinions_create_poll(bot, events)
+    group = poll_message['chat']
+    for i in range(args.updates):
+        update = events.message(101 + i % args.users, 'Option %s' % (i % 3), chat=group, reply_to_message=poll_message)
+        yield webhook(update), 1
+
+
+def opinions_vote_button(bot, args, events):
+    poll_message = opinions_create_poll(bot, events)
+    for i in range(args.updates):
+        yield webhook(events.callback(101 + i % args.users, 'vote,%s' % (i % 3), poll_message)), 1
+
+
+def opinions_vote_button_lock_free(bot, args, events):
+    """Poll message is updated without the lock table, see LOCK_CLIENT"""
+    bot.LOCK_CLIENT = False
+    return opinions_vote_button(bot, args, events)
+
+
+def opinions_vote_button_sqs(bot, args, events):
+    """Poll message is updated by jobs from SQS queue, see RENDER_QUEUE_URL"""
+    import boto3
+    sqs = boto3.client('sqs')
+    queue_url = sqs.create_queue(QueueName='render')['QueueUrl']
+    bot.render_queue = bot.SqsRenderQueue(queue_url)
+
+    def jobs(wait):
+        # the queue triggers the function with the jobs that are due
+        res = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10, WaitTimeSeconds=wait)
+        messages = res.get('Messages', [])
+        for m in messages:
+            sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=m['ReceiptHandle'])
+        if messages:
+            yield {'Records': [{'messageId': m['MessageId'], 'body': m['Body']} for m in messages]}, len(messages)
+
+    for event, updates in opinions_vote_button(bot, args, events):
+        yield event, updates
+        for job in jobs(0):
+            yield job
+    time.sleep(bot.UPDATING_POLL_MESSAGE_DELAY)
+    for job in jobs(1):
+        yield job
+
+
+def opinions_create_tables(bot):
+    from python_dynamodb_lock.python_dynamodb_lock import DynamoDBLockClient
+    import boto3
+    bot.Poll.create_table(read_capacity_units=5, write_capacity_units=5, wait=True)
+    DynamoDBLockClient.create_dynamodb_table(boto3.client('dynamodb'))
+
+
+def opinions_create_poll(bot, events):
+    opinions_create_tables(bot)
+    group = {'id': TARGET_GROUP, 'type': 'supergroup', 'title': 'Group'}
+    bot.lambda_handler(webhook(events.message(101, '/new Question?', chat=group)), None)
+    poll_message = FAKE_TELEGRAM.last_messages[TARGET_GROUP]
+    # add options
+    for i in range(3):
+        update = events.message(101, 'Option %s' % i, chat=group, reply_to_message=poll_message)
+        bot.lambda_handler(webhook(update), None)
+    return poll_message
+
+
+def resend_request_and_reply(bot, args, events):
+    group = {'id': TARGET_GROUP, 'type': 'supergroup', 'title': 'Support'}
+    for i in range(args.updates):
+        user_id = 101 + i % args.users
+        request = events.message(user_id, 'Question %s' % i)
+        yield webhook(request), 1
+        request_text = 'User: Question %s\nmsg:%s:%s' % (i, request['message']['message_id'], user_id)
+        reply_to = {'message_id': 1, 'chat': group, 'date': START_UNIXTIME, 'from': BOT_USER, 'text': request_text}
+        yield webhook(events.message(201, 'Answer %s' % i, chat=group, reply_to_message=reply_to)), 1
+
+
+def ifttt_event(bot, args, events):
+    for i in range(args.updates):
+        event = {
+            'queryStringParameters': {'event': 'benchmark'},
+            'body': json.dumps({'value1': 'Value %s' % i, 'value2': 'https://example.com/%s' % i, 'value3': ''}),
+        }
+        yield event, 1
+
+
+SCENARIOS = {
+    'todo-bot/new_task': todo_new_task,
+    'todo-bot/callback': todo_callback,
+    'todo-bot/callback_shared': todo_callback_shared,
+    'todo-bot/mytasks': todo_mytasks,
+    'todo-bot/forward_batch': todo_forward_batch,
+    'todo-bot/cron': todo_cron,
+    'opinions-bot/new_poll': opinions_new_poll,
+    'opinions-bot/vote_reply': opinions_vote_reply,
+    'opinions-bot/vote_button': opinions_vote_button,
+    'opinions-bot/vote_button_lock_free': opinions_vote_button_lock_free,
+    'opinions-bot/vote_button_sqs': opinions_vote_button_sqs,
+    'resend-bot/resend': resend_request_and_reply,
+    'ifttt-to-telegram/event': ifttt_event,
+}
+
+FAKE_TELEGRAM = None
+
+
+def corpus_scenario(path, name):
+    """Recorded events. Each line of the file is {"scenario": NAME, "event": EVENT}"""
+    def scenario(bot, args, events):
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record['scenario'] == name:
+                    yield record['event'], len(record['event'].get('Records', [])) or 1
+    return scenario
+
+
+def corpus_scenarios(path):
+    names = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                name = json.loads(line)['scenario']
+                if name not in names:
+                    names.append(name)
+    return names
+
+
+##########
+# Runner #
+##########
+
+
+def setup_bot(name, args):
+    """Set environment, load lambda_function of the bot and patch its clients"""
+    global FAKE_TELEGRAM
+    FAKE_TELEGRAM = FakeTelegram(args.telegram_latency / 1000.0)
+    db_latency = args.db_latency / 1000.0
+    users = dict((str(todo_user(args, i)), 'User%s' % todo_user(args, i)) for i in range(args.users))
+    env = {
+        'todo-bot': {
+            'BOT_TOKEN': BOT_TOKEN,
+            'USERS': json.dumps(users),
+            'STORAGE': 'memory',
+        },
+        'opinions-bot': {
+            'TELEGRAM_TOKEN': BOT_TOKEN,
+            'AWS_DEFAULT_REGION': 'us-east-1',
+            'AWS_ACCESS_KEY_ID': 'benchmark',
+            'AWS_SECRET_ACCESS_KEY': 'benchmark',
+        },
+        'resend-bot': {
+            'BOT_TOKEN': BOT_TOKEN,
+            'TARGET_GROUP': str(TARGET_GROUP),
+        },
+        'ifttt-to-telegram': {
+            'BOT_TOKEN': BOT_TOKEN,
+            'TELEGRAM_CHAT': str(TARGET_GROUP),
+            'EVENT_benchmark': '<b>{{Value1}}</b><br>{{Value2}}{{Value3}}',
+        },
+    }[name]
+    os.environ.update(env)
+
+    if name == 'opinions-bot':
+        start_moto()
+        patch_botocore(db_latency)
+        patch_python_telegram_bot(FAKE_TELEGRAM)
+    else:
+        patch_telebot(FAKE_TELEGRAM)
+
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), BOTS[name])
+    bot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bot)
+    if name == 'todo-bot':
+        bot.storage = CountingStorage(bot.storage, db_latency)
+    return bot
+
+
+def run_scenario(name, scenario, args):
+    bot = setup_bot(name.split('/')[0], args)
+    error_counter = ErrorCounter()
+    logging.getLogger().addHandler(error_counter)
+    if not bot.logger.propagate:
+        bot.logger.addHandler(error_counter)
+    events = Events()
+    latencies = []
+    calls = {'telegram': Counter(), 'db': Counter()}
+    # Bot API methods returned in webhook responses
+    webhook_calls = Counter()
+    updates = 0
+    errors = 0
+    if args.concurrency > 1:
+        run = run_concurrently
+    else:
+        run = run_sequentially
+    start = time.perf_counter()
+    for latency, event_updates, event_errors, method, event_calls in run(bot, scenario(bot, args, events), args, error_counter):
+        latencies.append(latency)
+        updates += event_updates
+        errors += event_errors
+        if method:
+            webhook_calls[method] += 1
+        for kind, counter in event_calls.items():
+            calls[kind].update(counter)
+    duration = time.perf_counter() - start
+
+    return {
+        'events': len(latencies),
+        'updates': updates,
+        'errors': errors,
+        'latency_ms': latency_stats(latencies),
+        'updates_per_sec': round(updates / duration, 3) if duration else None,
+        'telegram_calls': dict(calls['telegram']),
+        'webhook_calls': dict(webhook_calls),
+        'db_calls': dict(calls['db']),
+        'telegram_calls_per_update': round(sum(calls['telegram'].values()) / float(updates or 1), 3),
+        'db_calls_per_update': round(sum(calls['db'].values()) / float(updates or 1), 3),
+        # Linux reports kilobytes
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def handle(bot, event, args):
+    """Returns (latency, failed updates, webhook method)"""
+    context = FakeContext(args.timeout)
+    start = time.perf_counter()
+    failures = 0
+    method = None
+    try:
+        result = bot.lambda_handler(event, context)
+    except Exception:
+        logger.debug('Error on handling event', exc_info=True)
+        failures = None
+    else:
+        if isinstance(result, dict):
+            failures = len(result.get('batchItemFailures', []))
+        method = webhook_method(result)
+    return (time.perf_counter() - start) * 1000, failures, method
+
+
+def run_sequentially(bot, items, args, error_counter):
+    """Yields (latency, updates, errors, webhook method, outbound calls) per event"""
+    for event, event_updates in items:
+        recorder.reset()
+        error_counter.count = 0
+        latency, failures, method = handle(bot, event, args)
+        if failures is None:
+            errors = 1
+        else:
+            errors = max(failures, min(error_counter.count, event_updates))
+        yield latency, event_updates, errors, method, recorder.snapshot()
+
+
+def run_concurrently(bot, items, args, error_counter):
+    """The same, but --concurrency events are handled at once. Outbound calls
+    and logged errors can't be told apart by event, so they are reported by
+    the last event"""
+    # the scenario prepares data, e.g. a poll, before the first event
+    items = list(items)
+    recorder.reset()
+    error_counter.count = 0
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda item: handle(bot, item[0], args), items))
+    failures = sum(1 if failures is None else failures for _, failures, _ in results)
+    updates = sum(event_updates for _, event_updates in items)
+    errors = max(failures, min(error_counter.count, updates))
+    for i, (latency, _, method) in enumerate(results):
+        last = i == len(results) - 1
+        yield latency, items[i][1], errors if last else 0, method, recorder.snapshot() if last else {}
+
+
+def webhook_method(result):
+    """Bot API method in the response to webhook"""
+    if not isinstance(result, dict) or not result.get('body'):
+        return None
+    try:
+        return json.loads(result['body']).get('method')
+    except (ValueError, AttributeError):
+        return None
+
+
+def latency_stats(latencies):
+    if not latencies:
+        return {}
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        # nearest-rank method
+        index = max(0, int(round(p / 100.0 * len(latencies) + 0.5)) - 1)
+        return round(latencies[min(index, len(latencies) - 1)], 3)
+    return {
+        'p50': percentile(50),
+        'p95': percentile(95),
+        'p99': percentile(99),
+        'mean': round(sum(latencies) / len(latencies), 3),
+        'max': round(latencies[-1], 3),
+    }
+
+
+def run_in_subprocess(name, args):
+    """Each scenario runs in own process, so peak memory and module state
+    (caches, clients) don't leak between scenarios"""
+    cmd = [sys.executable, os.path.abspath(__file__), '--scenario', name, '--output', '-']
+    for key, value in sorted(vars(args).items()):
+        if key not in ['scenario', 'output'] and value is not None:
+            cmd += ['--%s' % key.replace('_', '-'), str(value)]
+    res = subprocess.run(cmd, stdout=subprocess.PIPE, check=True)
+    return json.loads(res.stdout.decode('utf-8'))['scenarios'][name]
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', action='append', help='Scenario to run. Can be repeated. Default: all')
+    parser.add_argument('--corpus', help='File with recorded events (JSON Lines) to replay instead of synthetic ones')
+    parser.add_argument('--updates', type=int, default=50, help='Number of events per scenario')
+    parser.add_argument('--users', type=int, default=5, help='Number of users sending the updates')
+    parser.add_argument('--tasks', type=int, default=20, help='Number of tasks per user for /mytasks and cron')
+    parser.add_argument('--batch-size', type=int, default=10, help='Number of records in a queue batch')
+    parser.add_argument('--telegram-latency', type=float, default=50, help='Milliseconds per Bot API request')
+    parser.add_argument('--db-latency', type=float, default=5, help='Milliseconds per DynamoDB request')
+    parser.add_argument('--timeout', type=float, default=60, help='Lambda timeout in seconds')
+    parser.add_argument('--concurrency', type=int, default=1, help='Number of events handled at once')
+    parser.add_argument('--output', default='-', help='File for the JSON report. Default: stdout')
+    parser.add_argument('--log-level', default='ERROR')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+    logging.basicConfig(level=getattr(logging, args.log_level), stream=sys.stderr)
+
+    available = corpus_scenarios(args.corpus) if args.corpus else sorted(SCENARIOS)
+    names = args.scenario or available
+    unknown = [name for name in names if name not in available or name.split('/')[0] not in BOTS]
+    if unknown:
+        sys.exit('Unknown scenarios: %s. Available: %s' % (', '.join(unknown), ', '.join(available)))
+
+    report = {
+        'version': REPORT_VERSION,
+        'settings': dict(vars(args), scenario=names, output=None, python=sys.version.split()[0]),
+        'scenarios': {},
+    }
+    if len(names) == 1:
+        name = names[0]
+        scenario = corpus_scenario(args.corpus, name) if args.corpus else SCENARIOS[name]
+        report['scenarios'][name] = run_scenario(name, scenario, args)
+    else:
+        for name in names:
+            sys.stderr.write('%s...\n' % name)
+            report['scenarios'][name] = run_in_subprocess(name, args)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output == '-':
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+class Metrics(object):
+    """Latency of calls made during an invocation, e.g. Bot API and DynamoDB calls.
+
+    The record is printed in CloudWatch Embedded Metric Format, so metrics
+    are extracted from the logs without extra requests. See
+    https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+
+    Each bot is deployed as a single file, so the class is copied to
+    lambda_function.py of every bot by common/sync.py. Edit common/metrics.py
+    instead of the copies.
+    """
+
+    def __init__(self, bot_name, enabled):
+        self.bot_name = bot_name
+        self.enabled = enabled
+        self.cold_start = True
+        self.start = time.time()
+        # name -> list of latencies in milliseconds
+        self.calls = {}
+        # calls may be made from other threads, e.g. workers of a pool
+        self.lock = threading.Lock()
+
+    def reset(self):
+        self.start = time.time()
+        self.calls = {}
+
+    def add(self, name, start):
+        if not self.enabled:
+            return
+        latency = (time.time() - start) * 1000
+        with self.lock:
+            self.calls.setdefault(name, []).append(latency)
+
+    def wrap(self, func, get_name):
+        """Returns func, that records its calls.
+
+        get_name computes the metric name from the call arguments. The call
+        is not recorded if the name is None.
+        """
+        def wrapper(*args, **kwargs):
+            name = get_name(*args, **kwargs)
+            if not name:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(name, start)
+        return wrapper
+
+    def emit(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            calls = dict(self.calls)
+        names = sorted(calls)
+        record = {
+            "_aws": {
+                "Timestamp": int(self.start * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [["Bot"]],
+                    "Metrics": [{"Name": "Duration", "Unit": "Milliseconds"}, {"Name": "ColdStart", "Unit": "Count"}]
+                    + [{"Name": name, "Unit": "Milliseconds"} for name in names]
+                    + [{"Name": name + ".count", "Unit": "Count"} for name in names],
+                }],
+            },
+            "Bot": self.bot_name,
+            "Duration": (time.time() - self.start) * 1000,
+            "ColdStart": int(self.cold_start),
+        }
+        for name in names:
+            record[name] = calls[name][:METRICS_MAX_VALUES]
+            record[name + ".count"] = len(calls[name])
+        self.cold_start = False
+        # EMF record has to be a separate line of the log
+        print(json.dumps(record), flush=True)
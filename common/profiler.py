@@ -0,0 +1,77 @@
+class Profiler(object):
+    """Sampling profiler of a slow invocation.
+
+    A background thread samples stacks of all threads, so time spent in
+    worker threads and in waiting for network is visible too. Samples are
+    kept only if the invocation takes longer than slower_than milliseconds.
+    Then they are written to a file in collapsed stack format, which is read
+    by flame graph tools, e.g. https://github.com/brendangregg/FlameGraph
+
+    Each bot is deployed as a single file, so the class is copied to
+    lambda_function.py of the bots by common/sync.py. Edit common/profiler.py
+    instead of the copies.
+    """
+
+    def __init__(self, slower_than, name):
+        self.slower_than = slower_than
+        self.name = name
+        # collapsed stack -> number of samples
+        self.samples = {}
+        self.thread = None
+
+    def __enter__(self):
+        if not self.slower_than:
+            return self
+        self.start = time.time()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if not self.thread:
+            return
+        self.stopped.set()
+        self.thread.join()
+        duration = (time.time() - self.start) * 1000
+        if duration < self.slower_than:
+            return
+        path = os.path.join(PROFILE_DIR, "%s-%s.folded" % (self.name, int(self.start * 1000)))
+        with open(path, "w") as f:
+            for stack, count in self.samples.items():
+                f.write("%s %s\n" % (stack, count))
+        logger.warning("Slow invocation: %.0f ms. Profile: %s. Hot functions (self, total samples):\n%s",
+                       duration, path, "\n".join("%s %s %s" % row for row in self.top(PROFILE_TOP)))
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(PROFILE_INTERVAL):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or self.is_idle_worker(frame):
+                    continue
+                stack = []
+                while frame:
+                    code = frame.f_code
+                    stack.append("%s (%s:%s)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stack = ";".join(reversed(stack))
+                self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def top(self, limit):
+        """Returns list of (function, self samples, total samples)"""
+        own = {}
+        total = {}
+        for stack, count in self.samples.items():
+            functions = stack.split(";")
+            own[functions[-1]] = own.get(functions[-1], 0) + count
+            # recursive functions are counted once per sample
+            for func in set(functions):
+                total[func] = total.get(func, 0) + count
+        rows = sorted(own.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [(func, count, total[func]) for func, count in rows]
+
+    @staticmethod
+    def is_idle_worker(frame):
+        """Whether the thread is a worker of ThreadPoolExecutor waiting for a job"""
+        code = frame.f_code
+        return code.co_name == "_worker" and code.co_filename.endswith(os.path.join("concurrent", "futures", "thread.py"))
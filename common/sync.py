@@ -0,0 +1,73 @@
+# Copyright 2020 Ivan Yelizariev <https://it-projects.info/team/yelizariev>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+"""Copy code shared by the bots to their lambda_function.py files.
+
+Each bot is deployed as a single file, so shared code is kept in this
+directory and copied to the bots between markers:
+
+    # BEGIN common/metrics.py
+    ...
+    # END common/metrics.py
+
+Edit the files here, never the copies, and run the script afterwards. With
+--check nothing is written, and the script fails if any copy is outdated.
+
+    python3 common/sync.py [--check]
+"""
+import argparse
+import os
+import sys
+
+COMMON = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(COMMON)
+
+# file of this directory -> bots, that have a copy of it
+SHARED = {
+    'metrics.py': ['todo-bot', 'opinions-bot', 'resend-bot', 'ifttt-to-telegram'],
+    'profiler.py': ['todo-bot', 'opinions-bot'],
+}
+
+
+def read(path):
+    with open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+def sync(check=False):
+    """Returns list of bot files with outdated copies. They are updated
+    unless check is True"""
+    outdated = []
+    for name, bots in sorted(SHARED.items()):
+        code = read(os.path.join(COMMON, name))
+        begin = '# BEGIN common/%s\n' % name
+        end = '# END common/%s\n' % name
+        for bot in bots:
+            path = os.path.join(ROOT, bot, 'lambda_function.py')
+            source = read(path)
+            start = source.find(begin)
+            stop = source.find(end, start)
+            if start < 0 or stop < 0:
+                raise Exception('Markers of common/%s are not found in %s' % (name, path))
+            start += len(begin)
+            if source[start:stop] == code:
+                continue
+            outdated.append(path)
+            if not check:
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(source[:start] + code + source[stop:])
+    return outdated
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--check', action='store_true', help="fail if copies are outdated, don't write them")
+    args = parser.parse_args()
+    outdated = sync(check=args.check)
+    for path in outdated:
+        print('%s %s' % ('Outdated:' if args.check else 'Updated:', os.path.relpath(path, ROOT)))
+    if args.check and outdated:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
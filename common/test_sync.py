@@ -0,0 +1,23 @@
+# Copyright 2020 Ivan Yelizariev <https://it-projects.info/team/yelizariev>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+"""Check that the bots have up-to-date copies of shared code.
+
+    python3 -m unittest discover -s common
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import sync  # noqa: E402
+
+
+class TestSync(unittest.TestCase):
+
+    def test_copies_are_up_to_date(self):
+        outdated = sync.sync(check=True)
+        self.assertEqual(outdated, [], 'Run python3 common/sync.py to update the copies')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,8 @@ import telebot  # https://github.com/eternnoir/pyTelegramBotAPI
 import os
 import logging
 import json
+import threading
+import time
 
 
 logger = logging.getLogger()
@@ -16,7 +18,111 @@ RESPONSE_200 = {
 }
 
 
+METRICS = os.environ.get('METRICS') == 'True'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'chatops')
+# Max number of values per metric in a metrics record
+METRICS_MAX_VALUES = 100
+
+
+# BEGIN common/metrics.py
+class Metrics(object):
+    """Latency of calls made during an invocation, e.g. Bot API and DynamoDB calls.
+
+    The record is printed in CloudWatch Embedded Metric Format, so metrics
+    are extracted from the logs without extra requests. See
+    https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+
+    Each bot is deployed as a single file, so the class is copied to
+    lambda_function.py of every bot by common/sync.py. Edit common/metrics.py
+    instead of the copies.
+    """
+
+    def __init__(self, bot_name, enabled):
+        self.bot_name = bot_name
+        self.enabled = enabled
+        self.cold_start = True
+        self.start = time.time()
+        # name -> list of latencies in milliseconds
+        self.calls = {}
+        # calls may be made from other threads, e.g. workers of a pool
+        self.lock = threading.Lock()
+
+    def reset(self):
+        self.start = time.time()
+        self.calls = {}
+
+    def add(self, name, start):
+        if not self.enabled:
+            return
+        latency = (time.time() - start) * 1000
+        with self.lock:
+            self.calls.setdefault(name, []).append(latency)
+
+    def wrap(self, func, get_name):
+        """Returns func, that records its calls.
+
+        get_name computes the metric name from the call arguments. The call
+        is not recorded if the name is None.
+        """
+        def wrapper(*args, **kwargs):
+            name = get_name(*args, **kwargs)
+            if not name:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(name, start)
+        return wrapper
+
+    def emit(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            calls = dict(self.calls)
+        names = sorted(calls)
+        record = {
+            "_aws": {
+                "Timestamp": int(self.start * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [["Bot"]],
+                    "Metrics": [{"Name": "Duration", "Unit": "Milliseconds"}, {"Name": "ColdStart", "Unit": "Count"}]
+                    + [{"Name": name, "Unit": "Milliseconds"} for name in names]
+                    + [{"Name": name + ".count", "Unit": "Count"} for name in names],
+                }],
+            },
+            "Bot": self.bot_name,
+            "Duration": (time.time() - self.start) * 1000,
+            "ColdStart": int(self.cold_start),
+        }
+        for name in names:
+            record[name] = calls[name][:METRICS_MAX_VALUES]
+            record[name + ".count"] = len(calls[name])
+        self.cold_start = False
+        # EMF record has to be a separate line of the log
+        print(json.dumps(record), flush=True)
+# END common/metrics.py
+
+
+def telegram_metric_name(token, method_name, *args, **kwargs):
+    return 'telegram.' + method_name
+
+
+metrics = Metrics('ifttt-to-telegram', METRICS)
+if METRICS:
+    telebot.apihelper._make_request = metrics.wrap(telebot.apihelper._make_request, telegram_metric_name)
+
+
 def lambda_handler(event, context):
+    metrics.reset()
+    try:
+        return handle_event(event, context)
+    finally:
+        metrics.emit()
+
+
+def handle_event(event, context):
     logger.debug("Event: \n%s", json.dumps(event))
 
     # READ event
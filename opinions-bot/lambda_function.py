@@ -1,20 +1,30 @@
 # Copyright 2020 Ivan Yelizariev <https://it-projects.info/team/yelizariev>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 import json
+import math
 import logging
 import os
 import re
+import sys
+import threading
 import boto3
+from botocore.client import BaseClient
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 import time
 
 from pynamodb.models import Model
-from pynamodb.attributes import MapAttribute, ListAttribute, NumberAttribute, VersionAttribute, UTCDateTimeAttribute, JSONAttribute, UnicodeAttribute
-from python_dynamodb_lock.python_dynamodb_lock import DynamoDBLockClient, DynamoDBLockError
+from pynamodb.connection import Connection
+from pynamodb.exceptions import UpdateError, TransactWriteError
+from pynamodb.expressions.condition import size
+from pynamodb.attributes import MapAttribute, ListAttribute, NumberAttribute, VersionAttribute, UTCDateTimeAttribute, JSONAttribute, UnicodeAttribute, BooleanAttribute
+from pynamodb.transactions import TransactGet, TransactWrite
+from python_dynamodb_lock.python_dynamodb_lock import DynamoDBLockClient
 
 # https://github.com/python-telegram-bot/python-telegram-bot
 from telegram import Update, Bot, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove
 import telegram
+from telegram.utils.request import Request
 
 bot = Bot(token=os.getenv('TELEGRAM_TOKEN'))
 BOT_ID = int(os.getenv('TELEGRAM_TOKEN').split(":")[0])
@@ -33,6 +43,7 @@ if LOG_LEVEL:
     logger.error("LOG_LEVEL: %s", LOG_LEVEL)
 
 DYNAMO_DB_TABLE_NAME = os.getenv("DYNAMO_DB_TABLE_NAME", "opinions-bot")
+DYNAMO_DB_VOTES_TABLE_NAME = os.getenv("DYNAMO_DB_VOTES_TABLE_NAME")
 ON_RESPONSE_TO_FORWARDED_MESSAGE="""To add your answer, reply to the original bot message, not the forwarded one.
 
 Forwarded message with question and answers are frozen forever. You can forward the message to fix current answers"""
@@ -40,12 +51,226 @@ Forwarded message with question and answers are frozen forever. You can forward
 NO_VOTES_YET="""To add your vote, please reply to this message"""
 
 UPDATING_POLL_MESSAGE_DELAY = 1 # seconds
+# Scheduled update of poll message that isn't done in this time is considered lost
+RENDER_TIMEOUT = 60 # seconds
+# Attempts to save a vote, when other voters change the poll at the same time
+VOTE_RETRIES = 5
+VOTE_RETRY_DELAY = 0.1 # seconds
+# Keep updates of a poll message in order by the lock table. Otherwise by
+# telegram_version of the poll, see render_poll_by_version
+LOCK_CLIENT = os.getenv("LOCK_CLIENT", "True") == "True"
+# Attempts to update poll message, when newer updates run at the same time
+RENDER_RETRIES = 3
+# Number of partitions for votes of a poll, see Vote. Changing it makes
+# existing sharded votes unreachable
+VOTE_SHARDS = 10
+# Max number of voter names shown for sharded votes
+VOTERS_SAMPLE_SIZE = 30
+SQS_MAX_DELAY = 900 # seconds
+RENDER_QUEUE_URL = os.getenv("RENDER_QUEUE_URL")
 MAX_INLINE_OPTIONS=30
+# Max length of message text after parsing of entities
+MAX_MESSAGE_LENGTH = 4096
+METRICS = os.getenv("METRICS") == "True"
+METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE", "chatops")
+PROFILE_SLOWER_THAN = int(os.getenv("PROFILE_SLOWER_THAN", 0))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp")
+# Max number of values per metric in a metrics record
+METRICS_MAX_VALUES = 100
+# Seconds between samples of the profiler
+PROFILE_INTERVAL = 0.01
+# Number of hot functions to log for a slow invocation
+PROFILE_TOP = 20
+
+# BEGIN common/metrics.py
+class Metrics(object):
+    """Latency of calls made during an invocation, e.g. Bot API and DynamoDB calls.
+
+    The record is printed in CloudWatch Embedded Metric Format, so metrics
+    are extracted from the logs without extra requests. See
+    https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+
+    Each bot is deployed as a single file, so the class is copied to
+    lambda_function.py of every bot by common/sync.py. Edit common/metrics.py
+    instead of the copies.
+    """
+
+    def __init__(self, bot_name, enabled):
+        self.bot_name = bot_name
+        self.enabled = enabled
+        self.cold_start = True
+        self.start = time.time()
+        # name -> list of latencies in milliseconds
+        self.calls = {}
+        # calls may be made from other threads, e.g. workers of a pool
+        self.lock = threading.Lock()
+
+    def reset(self):
+        self.start = time.time()
+        self.calls = {}
+
+    def add(self, name, start):
+        if not self.enabled:
+            return
+        latency = (time.time() - start) * 1000
+        with self.lock:
+            self.calls.setdefault(name, []).append(latency)
+
+    def wrap(self, func, get_name):
+        """Returns func, that records its calls.
+
+        get_name computes the metric name from the call arguments. The call
+        is not recorded if the name is None.
+        """
+        def wrapper(*args, **kwargs):
+            name = get_name(*args, **kwargs)
+            if not name:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(name, start)
+        return wrapper
+
+    def emit(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            calls = dict(self.calls)
+        names = sorted(calls)
+        record = {
+            "_aws": {
+                "Timestamp": int(self.start * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [["Bot"]],
+                    "Metrics": [{"Name": "Duration", "Unit": "Milliseconds"}, {"Name": "ColdStart", "Unit": "Count"}]
+                    + [{"Name": name, "Unit": "Milliseconds"} for name in names]
+                    + [{"Name": name + ".count", "Unit": "Count"} for name in names],
+                }],
+            },
+            "Bot": self.bot_name,
+            "Duration": (time.time() - self.start) * 1000,
+            "ColdStart": int(self.cold_start),
+        }
+        for name in names:
+            record[name] = calls[name][:METRICS_MAX_VALUES]
+            record[name + ".count"] = len(calls[name])
+        self.cold_start = False
+        # EMF record has to be a separate line of the log
+        print(json.dumps(record), flush=True)
+# END common/metrics.py
+
+def telegram_metric_name(request, url, *args, **kwargs):
+    return "telegram." + url.rsplit("/", 1)[-1]
+
+def dynamodb_metric_name(client, operation_name, api_params):
+    # pynamodb and the lock client use botocore clients
+    if client.meta.service_model.service_name == "dynamodb":
+        return "dynamodb." + operation_name
+
+metrics = Metrics("opinions-bot", METRICS)
+if METRICS:
+    # Nothing is wrapped, when metrics are disabled
+    Request.post = metrics.wrap(Request.post, telegram_metric_name)
+    BaseClient._make_api_call = metrics.wrap(BaseClient._make_api_call, dynamodb_metric_name)
+
+# BEGIN common/profiler.py
+class Profiler(object):
+    """Sampling profiler of a slow invocation.
+
+    A background thread samples stacks of all threads, so time spent in
+    worker threads and in waiting for network is visible too. Samples are
+    kept only if the invocation takes longer than slower_than milliseconds.
+    Then they are written to a file in collapsed stack format, which is read
+    by flame graph tools, e.g. https://github.com/brendangregg/FlameGraph
+
+    Each bot is deployed as a single file, so the class is copied to
+    lambda_function.py of the bots by common/sync.py. Edit common/profiler.py
+    instead of the copies.
+    """
+
+    def __init__(self, slower_than, name):
+        self.slower_than = slower_than
+        self.name = name
+        # collapsed stack -> number of samples
+        self.samples = {}
+        self.thread = None
+
+    def __enter__(self):
+        if not self.slower_than:
+            return self
+        self.start = time.time()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if not self.thread:
+            return
+        self.stopped.set()
+        self.thread.join()
+        duration = (time.time() - self.start) * 1000
+        if duration < self.slower_than:
+            return
+        path = os.path.join(PROFILE_DIR, "%s-%s.folded" % (self.name, int(self.start * 1000)))
+        with open(path, "w") as f:
+            for stack, count in self.samples.items():
+                f.write("%s %s\n" % (stack, count))
+        logger.warning("Slow invocation: %.0f ms. Profile: %s. Hot functions (self, total samples):\n%s",
+                       duration, path, "\n".join("%s %s %s" % row for row in self.top(PROFILE_TOP)))
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(PROFILE_INTERVAL):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or self.is_idle_worker(frame):
+                    continue
+                stack = []
+                while frame:
+                    code = frame.f_code
+                    stack.append("%s (%s:%s)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stack = ";".join(reversed(stack))
+                self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def top(self, limit):
+        """Returns list of (function, self samples, total samples)"""
+        own = {}
+        total = {}
+        for stack, count in self.samples.items():
+            functions = stack.split(";")
+            own[functions[-1]] = own.get(functions[-1], 0) + count
+            # recursive functions are counted once per sample
+            for func in set(functions):
+                total[func] = total.get(func, 0) + count
+        rows = sorted(own.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [(func, count, total[func]) for func, count in rows]
+
+    @staticmethod
+    def is_idle_worker(frame):
+        """Whether the thread is a worker of ThreadPoolExecutor waiting for a job"""
+        code = frame.f_code
+        return code.co_name == "_worker" and code.co_filename.endswith(os.path.join("concurrent", "futures", "thread.py"))
+# END common/profiler.py
 
 def lambda_handler(event, context):
+    metrics.reset()
+    try:
+        with Profiler(PROFILE_SLOWER_THAN, "opinions-bot"):
+            return handle_event(event, context)
+    finally:
+        metrics.emit()
+
+def handle_event(event, context):
     # read event
     logger.debug("Event: \n%s", json.dumps(event))
 
+    if event.get("Records"):
+        return handle_render_jobs(event["Records"])
+
     telegram_payload = None
     cloudwatch_time = None
     if event.get("source") == "aws.events":
@@ -55,18 +280,37 @@ def lambda_handler(event, context):
         logger.debug("Telegram event: \n%s", telegram_payload)
 
     # handle event
+    response_method = None
     try:
         if telegram_payload:
-            handle_telegram(telegram_payload)
+            response_method = handle_telegram(telegram_payload)
         elif cloudwatch_time:
             handle_cron(cloudwatch_time)
     except:
         logger.error("Error on handling event", exc_info=True)
+    finally:
+        render_queue.wait()
 
     # return ok to telegram server
-    return {"statusCode": 200, "headers": {}, "body": ""}
+    return webhook_response(response_method)
+
+def webhook_response(method=None):
+    """Response to telegram server.
+
+    It may contain a Bot API method to call. That saves a request to telegram,
+    but errors of the method are not reported. See
+    https://core.telegram.org/bots/api#making-requests-when-getting-updates
+    """
+    if not method:
+        return {"statusCode": 200, "headers": {}, "body": ""}
+    return {
+        "statusCode": 200,
+        "headers": {"Content-Type": "application/json"},
+        "body": json.dumps(method),
+    }
 
 def handle_telegram(telegram_payload):
+    """Returns Bot API method to call in response to telegram, if any"""
     update = Update.de_json(telegram_payload, bot)
 
     if update.callback_query:
@@ -77,29 +321,39 @@ def handle_telegram(telegram_payload):
         return
 
     if message.text == "/start":
-        bot.sendMessage(message.chat.id, """This is a poll bot. To create a poll, add this bot to a group and send a poll question with "/new " prefix. For more information check out this page:\nhttps://itpp.dev/chat/opinions-bot/index.html""")
-        return
+        return {
+            "method": "sendMessage",
+            "chat_id": message.chat.id,
+            "text": """This is a poll bot. To create a poll, add this bot to a group and send a poll question with "/new " prefix. For more information check out this page:\nhttps://itpp.dev/chat/opinions-bot/index.html""",
+        }
 
     if DEBUG:
         # Create tables
         with CreateTableIfNotExists():
             Poll.create_table(read_capacity_units=5, write_capacity_units=5, wait=True)
 
-        with CreateTableIfNotExists():
-            ddb_client = boto3.client('dynamodb')
-            DynamoDBLockClient.create_dynamodb_table(ddb_client)
+        if DYNAMO_DB_VOTES_TABLE_NAME:
+            with CreateTableIfNotExists():
+                Vote.create_table(read_capacity_units=5, write_capacity_units=5, wait=True)
+
+        if LOCK_CLIENT:
+            with CreateTableIfNotExists():
+                ddb_client = boto3.client('dynamodb')
+                DynamoDBLockClient.create_dynamodb_table(ddb_client)
 
     poll_message = message.reply_to_message
     if poll_message:
         if poll_message.forward_from and poll_message.forward_from.id == BOT_ID:
             # This may happen only is bot has access to all message.
             # Reply to forwarded message, rather than original one.
-            bot.sendMessage(
-                message.chat.id,
-                "<em>%s</em>" % ON_RESPONSE_TO_FORWARDED_MESSAGE,
-                parse_mode='HTML',
-                reply_to_message_id=message.message_id
-            )
+            return {
+                "method": "sendMessage",
+                "chat_id": message.chat.id,
+                "text": "<em>%s</em>" % ON_RESPONSE_TO_FORWARDED_MESSAGE,
+                "parse_mode": "HTML",
+                "reply_to_message_id": message.message_id,
+                "allow_sending_without_reply": True,
+            }
         elif  poll_message.from_user.id != BOT_ID:
             # Reply to third-party message.
             # Ignore.
@@ -157,148 +411,430 @@ def create_poll(message, question):
     poll.key = message2poll_key(poll_message)
     poll.telegram_datetime = get_now()
     poll.telegram_version = 1
+    if DYNAMO_DB_VOTES_TABLE_NAME:
+        poll.sharded_votes = True
     poll.save()
 
 def set_vote(telegram_user, poll_key, option_id=None, option_text=None, reply=None):
-    poll = Poll.get(poll_key)
+    """Save the vote and schedule update of the poll message.
+
+    Nothing is written if the vote is not changed.
+    """
     user_id = str(telegram_user.id)
-    if option_text:
-        # add option if it doesn't exist yet
-        with CheckCondition():
-            poll.update(
-                actions=[Poll.options.set(
-                    Poll.options.append([option_text])
-                )],
-                condition=~Poll.options.contains(option_text)
-            )
-        # compute option_id
-        for option_id, text in enumerate(poll.options):
-            if text == option_text:
-                break
+    for attempt in range(VOTE_RETRIES):
+        now = get_now()
+        vote = None
+        if DYNAMO_DB_VOTES_TABLE_NAME:
+            poll, vote = get_poll_and_vote(poll_key, user_id)
+            if not poll:
+                logger.debug("Poll doesn't exist: %s", poll_key)
+                return
+        else:
+            # only text votes need the options
+            poll = Poll.get(poll_key) if option_text else Poll.for_update(poll_key)
+        if poll.sharded_votes:
+            saved = save_sharded_vote(poll, vote, telegram_user, option_id, option_text, now)
+        else:
+            saved = save_vote(poll, telegram_user, option_id, option_text, now)
+        if saved is None:
+            # the poll is changed by another voter
+            time.sleep(VOTE_RETRY_DELAY * attempt)
+            continue
+        if saved:
+            schedule_render(poll, now)
+        else:
+            logger.debug("Vote is not changed")
+        return
+    raise Exception("Vote is not saved after %s attempts" % VOTE_RETRIES)
 
-    else:
+def get_option_id(poll, option_id, option_text):
+    """Returns option_id and whether the option has to be added"""
+    if not option_text:
         assert option_id is not None
+        return option_id, False
+    if option_text in poll.options:
+        return poll.options.index(option_text), False
+    return len(poll.options), True
+
+def save_vote(poll, telegram_user, option_id, option_text, now):
+    """Save the vote in the poll item by a single write.
 
+    The write adds the option if needed, saves user data and the vote, and
+    marks the poll for update of its message. Returns False if the vote is
+    not changed and None if options were changed by another voter.
+    """
+    user_id = str(telegram_user.id)
+    option_id, new_option = get_option_id(poll, option_id, option_text)
+    if option_text and not new_option:
+        # the poll is read, so the vote can be checked without a write
+        try:
+            if poll.votes[user_id] == option_id:
+                return False
+        except KeyError:
+            # no vote yet
+            pass
+    actions = [
+        Poll.users[user_id].set(telegram2json(telegram_user)),
+        Poll.votes[user_id].set(option_id),
+        # keep the mark of an earlier vote, if any
+        Poll.render_requested_at.set(Poll.render_requested_at | now),
+    ]
+    condition = Poll.key.exists() & (Poll.votes[user_id].does_not_exist() | (Poll.votes[user_id] != option_id))
+    if new_option:
+        actions.append(Poll.options.set(Poll.options.append([option_text])))
+        # fails if another voter adds an option at the same time
+        condition &= size(Poll.options) == option_id
     try:
-        if poll.votes[user_id] == option_id:
-            logger.debug("Vote is not changed")
-            return
-    except KeyError:
-        # no vote yet
-        pass
+        poll.update(actions=actions, condition=condition, add_version_condition=False)
+    except UpdateError as e:
+        if e.cause_response_code != "ConditionalCheckFailedException":
+            raise
+        if option_text:
+            # check the reason with fresh options
+            return None
+        # the vote is not changed or the poll doesn't exist
+        return False
+    return True
 
-    # Add user if it doesn't exist yet.
-    db_user = telegram2json(telegram_user)
-    with CheckCondition():
-        poll.update(
-            actions=[Poll.users[user_id].set(db_user)],
-            condition=~Poll.users[user_id].exists()
-        )
+def get_poll_and_vote(poll_key, user_id):
+    """Read the poll and the vote of the user by a single request"""
+    with TransactGet(connection) as transaction:
+        poll_future = transaction.get(Poll, poll_key)
+        vote_future = transaction.get(Vote, Vote.get_shard_key(poll_key, user_id), user_id)
+    try:
+        poll = poll_future.get()
+    except Poll.DoesNotExist:
+        poll = None
+    try:
+        vote = vote_future.get()
+    except Vote.DoesNotExist:
+        vote = None
+    return poll, vote
 
-    # Update vote
-    poll.update(
-        actions=[Poll.votes[user_id].set(option_id)],
-    )
+def save_sharded_vote(poll, vote, telegram_user, option_id, option_text, now):
+    """Save the vote in the Vote table, update counters of the poll and mark
+    it for update of its message.
 
+    All is written by a single transaction. Returns False if the vote is
+    not changed and None if the poll or the vote were changed by another
+    request.
+    """
+    user_id = str(telegram_user.id)
+    option_id, new_option = get_option_id(poll, option_id, option_text)
+    old_option_id = vote.option_id if vote else None
+    if option_id == old_option_id:
+        return False
+    counter = Poll.counts[str(option_id)]
+    actions = [counter.set((counter | 0) + 1)]
+    condition = Poll.key.exists()
+    # The transaction doesn't return the new values, so the mark is checked
+    # against the value read with the poll
+    requested_at = poll.render_requested_at
+    if requested_at:
+        condition &= Poll.render_requested_at == requested_at
+    else:
+        actions.append(Poll.render_requested_at.set(now))
+        condition &= Poll.render_requested_at.does_not_exist()
+    if old_option_id is not None:
+        old_counter = Poll.counts[str(old_option_id)]
+        actions.append(old_counter.set(old_counter - 1))
+    if new_option:
+        actions.append(Poll.options.set(Poll.options.append([option_text])))
+        condition &= size(Poll.options) == option_id
+    new_vote = Vote(
+        Vote.get_shard_key(poll.key, user_id), user_id,
+        option_id=option_id,
+        user=telegram2json(telegram_user),
+    )
     try:
-        update_poll_message(poll)
-    except DynamoDBLockError as e:
-        # Ignore ACQUIRE_TIMEOUT. It most cases it means that we got big queue
-        # of workers and can simply kill most of them. For example, we got 100
-        # votes in a second, then few of them will get the lock, one of them
-        # will update poll-message, while the rest have nothing to do.
-        logger.debug("DynamoDBLockError: %s", e.code)
-        if e.code != DynamoDBLockError.ACQUIRE_TIMEOUT:
-            raise
+        with TransactWrite(connection=connection) as transaction:
+            transaction.update(poll, actions=actions, condition=condition, add_version_condition=False)
+            transaction.save(new_vote, condition=(
+                Vote.option_id == old_option_id if vote else Vote.user_id.does_not_exist()
+            ))
+    except TransactWriteError as e:
+        reasons = [r.code for r in e.cancellation_reasons if r] if e.cause_response_code == "TransactionCanceledException" else []
+        # TransactionConflict means that another transaction changes the poll
+        if reasons and all(code in ("ConditionalCheckFailed", "TransactionConflict") for code in reasons):
+            return None
+        raise
+    poll.render_requested_at = requested_at or now
+    return True
 
-def update_poll_message(poll):
-    # get a reference to the DynamoDB resource
-    dynamodb_resource = boto3.resource('dynamodb')
+def schedule_render(poll, now):
+    """Schedule update of the poll message.
 
-    # create the lock-client
-    lock_client = DynamoDBLockClient(dynamodb_resource)
-    with lock_client.acquire_lock(
-            DYNAMO_DB_TABLE_NAME + ":" + poll.key,
+    Votes don't update the message themselves. A vote sets
+    render_requested_at, unless an earlier vote has set it already. The vote
+    that sets it schedules a job, which shows all votes made by the time it
+    runs. So the message is edited at most once per
+    UPDATING_POLL_MESSAGE_DELAY and voters don't wait for each other.
+
+    poll is the state right after the vote, and now is the time the vote set
+    in render_requested_at.
+    """
+    requested_at = poll.render_requested_at
+    if requested_at < now - timedelta(seconds=RENDER_TIMEOUT):
+        # The job is lost. Only one of concurrent voters replaces it
+        try:
+            poll.update(
+                actions=[Poll.render_requested_at.set(now)],
+                condition=Poll.render_requested_at == requested_at,
+                add_version_condition=False,
+            )
+        except UpdateError as e:
+            if e.cause_response_code != "ConditionalCheckFailedException":
+                raise
+            return
+    elif requested_at != now:
+        # the scheduled job will show this vote
+        return
+    render_at = max(now, poll.telegram_datetime + timedelta(seconds=UPDATING_POLL_MESSAGE_DELAY))
+    render_queue.schedule(poll.key, (render_at - now).total_seconds())
+
+def render_poll(poll_key):
+    """Update poll message with current votes"""
+    if not LOCK_CLIENT:
+        return render_poll_by_version(poll_key)
+    start = time.time()
+    try:
+        # Jobs of the same poll are scheduled at least
+        # UPDATING_POLL_MESSAGE_DELAY apart, so the lock is rarely busy. It
+        # keeps the edits in order, when a job is late
+        lock = get_lock_client().acquire_lock(
+            DYNAMO_DB_TABLE_NAME + ":" + poll_key,
             retry_period=timedelta(seconds=UPDATING_POLL_MESSAGE_DELAY/3),
             retry_timeout=timedelta(seconds=UPDATING_POLL_MESSAGE_DELAY*5),
             raise_context_exception=True,
-    ):
-        poll.refresh()
+        )
+    finally:
+        # time out is recorded too
+        metrics.add("lock.acquire", start)
+    with lock:
+        edit_poll_message(start_render(poll_key))
 
-        if poll.version == poll.telegram_version:
-            # no need to update
-            logger.debug("Poll was already updated. Exit")
+def render_poll_by_version(poll_key):
+    """Update poll message without the lock table.
+
+    Each attempt takes the next telegram_version by the write that reads the
+    poll. Only the attempt with the latest version edits the message, as
+    it shows the newest votes. If a newer attempt has started by the end of
+    the edit, the edits may have reached telegram in the wrong order, i.e.
+    the message may show older votes. So the poll is rendered again.
+    """
+    for attempt in range(RENDER_RETRIES):
+        poll = start_render(poll_key)
+        if not is_latest_render(poll):
+            # the newer attempt shows the votes
+            return
+        edit_poll_message(poll)
+        if is_latest_render(poll):
             return
+        logger.debug("Poll message %s is updated concurrently, attempt %s", poll_key, attempt)
+    raise Exception("Poll message is not updated after %s attempts" % RENDER_RETRIES)
 
-        now = get_now()
-        logger.debug("Checking for sleep: now is %s, last update is %s", now, poll.telegram_datetime)
-        since_last_update = (now - poll.telegram_datetime).total_seconds()
-        if since_last_update < UPDATING_POLL_MESSAGE_DELAY:
-            sleep = UPDATING_POLL_MESSAGE_DELAY - since_last_update
-            logger.debug("Sleep for %ssec", poll)
-            time.sleep(sleep)
-            poll.refresh()
-
-        chat_id, message_id = poll2chat_message_ids(poll)
-        # Update text
-        try:
-            bot.editMessageText(
-                poll2text(poll),
-                chat_id,
-                message_id,
-                parse_mode='HTML',
-            )
-        except telegram.error.BadRequest as e:
-            if e.message != "Message is not modified: specified new message content and reply markup are exactly the same as a current content and reply markup of the message":
-                raise
+def is_latest_render(poll):
+    latest = Poll.get(poll.key, consistent_read=True, attributes_to_get=["telegram_version"])
+    return latest.telegram_version == poll.telegram_version
 
-        # Update Markup
-        bot.editMessageReplyMarkup(
+def start_render(poll_key):
+    """Returns the poll to show. The poll is read by the write, so votes made
+    after this point schedule a new job"""
+    poll = Poll.for_update(poll_key)
+    poll.update(
+        actions=[
+            Poll.render_requested_at.remove(),
+            Poll.telegram_datetime.set(get_now()),
+            Poll.telegram_version.add(1),
+        ],
+        condition=Poll.key.exists(),
+        add_version_condition=False,
+    )
+    if poll.sharded_votes:
+        poll.load_voters()
+    return poll
+
+def edit_poll_message(poll):
+    chat_id, message_id = poll2chat_message_ids(poll)
+    try:
+        bot.editMessageText(
+            poll2text(poll),
             chat_id,
             message_id,
+            parse_mode='HTML',
             reply_markup=poll2markup(poll),
         )
-        poll.telegram_version = poll.version + 1
-        poll.telegram_datetime = get_now()
-        poll.save()
+    except telegram.error.BadRequest as e:
+        if e.message != "Message is not modified: specified new message content and reply markup are exactly the same as a current content and reply markup of the message":
+            raise
+
+lock_client = None
+lock_client_lock = threading.Lock()
+
+def get_lock_client():
+    """The client is shared by invocations of the container. Each client runs
+    own heartbeat threads"""
+    global lock_client
+    with lock_client_lock:
+        if not lock_client:
+            lock_client = DynamoDBLockClient(boto3.resource('dynamodb'))
+        return lock_client
+
+class LocalRenderQueue(object):
+    """Runs scheduled jobs by timers of the process.
+
+    Lambda freezes the process once the handler returns, so the handler
+    waits for the jobs it has scheduled, i.e. a voter may wait for
+    UPDATING_POLL_MESSAGE_DELAY. It's a fallback for development, use
+    SqsRenderQueue in production.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timers = []
+
+    def schedule(self, poll_key, delay):
+        timer = threading.Timer(delay, self._render, [poll_key])
+        timer.start()
+        with self.lock:
+            self.timers.append(timer)
+
+    def _render(self, poll_key):
+        try:
+            render_poll(poll_key)
+        except:
+            logger.error("Error on updating poll message %s", poll_key, exc_info=True)
+
+    def wait(self):
+        with self.lock:
+            timers, self.timers = self.timers, []
+        for timer in timers:
+            timer.join()
+
+class SqsRenderQueue(object):
+    """Sends scheduled jobs to SQS queue with delivery delay.
+
+    The queue triggers the Lambda, so no invocation waits for the delay.
+    """
+
+    def __init__(self, queue_url):
+        self.queue_url = queue_url
+        self.client = boto3.client('sqs')
+
+    def schedule(self, poll_key, delay):
+        self.client.send_message(
+            QueueUrl=self.queue_url,
+            MessageBody=json.dumps({"poll_key": poll_key}),
+            DelaySeconds=min(int(math.ceil(delay)), SQS_MAX_DELAY),
+        )
+
+    def wait(self):
+        pass
+
+render_queue = SqsRenderQueue(RENDER_QUEUE_URL) if RENDER_QUEUE_URL else LocalRenderQueue()
+
+def handle_render_jobs(records):
+    """Run jobs from RENDER_QUEUE_URL. Failed jobs are retried by the queue"""
+    failed = []
+    for record in records:
+        try:
+            render_poll(json.loads(record["body"])["poll_key"])
+        except:
+            logger.error("Error on updating poll message", exc_info=True)
+            failed.append(record["messageId"])
+    # See https://docs.aws.amazon.com/lambda/latest/dg/with-sqs.html#services-sqs-batchfailurereporting
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failed]}
 
 def poll2text(poll):
-    msg = []
-    msg.append("<em>%s</em>" % poll.question)
-    msg.append("")
-    total = len([v for v in poll.votes])
+    """Text of poll message.
 
-    users_by_option_id = poll.get_users_by_option_id()
+    If the text doesn't fit MAX_MESSAGE_LENGTH, lists of voters are
+    shortened, e.g. "Ann, Bob and 5 more". Percentages are computed from
+    all votes anyway. A question that leaves no room for the options is cut.
+    """
+    tally = poll.get_tally()
+    if not tally.total:
+        html, text = render_question(poll.question, ["<em>%s</em>" % NO_VOTES_YET], [NO_VOTES_YET], cut=True)
+        return html
+    options = [(option_id, option_text) for option_id, option_text in enumerate(poll.options) if tally.counts.get(option_id)]
 
-    has_votes = False
-    for option_id, option_text in enumerate(poll.options):
-        users = users_by_option_id.get(option_id)
-        if not users:
-            continue
-        has_votes = True
-        users_links = [user2link(u) for u in users]
-        msg.append("* %s — %s <b>%.1f%%</b>" % (
-            option_text,
-            ', '.join(users_links),
-            100.0 * len(users)/total,
-        ))
-    if not has_votes:
-        msg.append("<em>%s</em>" % NO_VOTES_YET)
-    logger.debug("poll2text: %s", msg)
-    return "\n".join(msg)
+    def render(options, max_voters, more_options=0, cut=False):
+        """Returns html and visible text of the message"""
+        html = []
+        text = []
+        for option_id, option_text in options:
+            count = tally.counts[option_id]
+            voters = tally.voters.get(option_id, [])[:max_voters]
+            if not voters:
+                more = "%s voter%s" % (count, "" if count == 1 else "s")
+            elif count > len(voters):
+                more = " and %s more" % (count - len(voters))
+            else:
+                more = ""
+            percent = "%.1f%%" % (100.0 * count / tally.total)
+            html.append("* %s — %s%s <b>%s</b>" % (option_text, ", ".join(link for link, name in voters), more, percent))
+            text.append("* %s — %s%s %s" % (option_text, ", ".join(name for link, name in voters), more, percent))
+        if more_options:
+            html.append("<em>and %s more options</em>" % more_options)
+            text.append("and %s more options" % more_options)
+        return render_question(question, html, text, cut)
+
+    def fits(message):
+        return text_length(message[1]) <= MAX_MESSAGE_LENGTH
+
+    # options without voters take precedence over the end of a long question,
+    # but the question keeps at least half of the message
+    question = ""
+    room = MAX_MESSAGE_LENGTH - text_length(render(options, 0)[1])
+    question = shorten(poll.question, max(room, MAX_MESSAGE_LENGTH // 2))
+
+    # the largest number of voters per option, that fits
+    low = 0
+    high = max(len(voters) for voters in tally.voters.values()) if tally.voters else 0
+    if fits(render(options, high)):
+        low = high
+    while low < high - 1:
+        middle = (low + high) // 2
+        if fits(render(options, middle)):
+            low = middle
+        else:
+            high = middle
+    # too many options even without voters
+    shown = len(options)
+    while shown and not fits(render(options[:shown], low, len(options) - shown)):
+        shown -= 1
+    html, text = render(options[:shown], low, len(options) - shown, cut=True)
+    logger.debug("poll2text: %s", html)
+    return html
+
+def render_question(question, html_lines, text_lines, cut=False):
+    """Returns html and visible text of the message with the lines under the
+    question. With cut, the question is cut, if the message doesn't fit"""
+    text = "\n".join([question, ""] + text_lines)
+    overflow = text_length(text) - MAX_MESSAGE_LENGTH
+    if cut and overflow > 0:
+        question = shorten(question, text_length(question) - overflow)
+        text = "\n".join([question, ""] + text_lines)
+    return "\n".join(["<em>%s</em>" % question, ""] + html_lines), text
+
+def shorten(text, length):
+    """Cut text to length in UTF-16 code units, including the ellipsis"""
+    if text_length(text) <= length:
+        return text
+    # a surrogate pair cut in half is dropped
+    return text.encode("utf-16-le")[:2 * max(length - 1, 0)].decode("utf-16-le", "ignore") + "…"
+
+def text_length(text):
+    """Length of text in UTF-16 code units, as telegram counts it"""
+    return len(text.encode("utf-16-le")) // 2
 
 def poll2markup(poll):
     buttons = []
 
     opt_by_id = dict(enumerate(poll.options))
 
-    opt_users = sorted(
-        poll.get_users_by_option_id().items(),
-        key=lambda item: len(item[1]),
-        reverse=True
-    )
     i = 0
-    for option_id, users in opt_users:
+    for option_id in poll.get_tally().option_ids:
         # make buttons for options with votes
         opt = opt_by_id[option_id]
         buttons.append(InlineKeyboardButton(
@@ -345,6 +881,20 @@ class Poll(Model):
     # information about poll message in telegram
     telegram_version = NumberAttribute()
     telegram_datetime = UTCDateTimeAttribute()
+    # time of the vote, that scheduled update of poll message, if any
+    render_requested_at = UTCDateTimeAttribute(null=True)
+    # Votes are kept in the Vote table rather than in votes and users
+    sharded_votes = BooleanAttribute(null=True)
+    # option_id -> number of votes. Only for sharded votes
+    counts = MapAttribute(default=dict)
+
+    @classmethod
+    def for_update(cls, key):
+        """Returns poll to update without reading it first.
+
+        Updates of such poll don't check version. It's only incremented.
+        """
+        return cls(key, version=0)
 
     def get_users_by_option_id(self):
         users_by_option_id = {}
@@ -354,6 +904,73 @@ class Poll(Model):
             users_by_option_id[option_id].append(self.users[user_id])
         return users_by_option_id
 
+    def get_tally(self):
+        """Returns Tally of the votes.
+
+        It's computed once and kept until the poll is read or updated again.
+        For sharded votes the voters are a sample, see load_voters.
+        """
+        if getattr(self, "_tally", None):
+            return self._tally
+        if self.sharded_votes:
+            counts = dict((int(option_id), count) for option_id, count in self.counts.as_dict().items() if count)
+            users_by_option_id = {}
+            for vote in getattr(self, "voters", []):
+                users_by_option_id.setdefault(vote.option_id, []).append(vote.user)
+        else:
+            users_by_option_id = self.get_users_by_option_id()
+            counts = dict((option_id, len(users)) for option_id, users in users_by_option_id.items())
+        self._tally = Tally(counts, users_by_option_id)
+        return self._tally
+
+    def deserialize(self, *args, **kwargs):
+        self._tally = None
+        return super(Poll, self).deserialize(*args, **kwargs)
+
+    def load_voters(self):
+        """Read a sample of sharded votes to show voter names"""
+        def query(shard):
+            return list(Vote.query("%s:%s" % (self.key, shard), limit=VOTERS_SAMPLE_SIZE // VOTE_SHARDS))
+        with ThreadPoolExecutor(max_workers=VOTE_SHARDS) as executor:
+            self.voters = [vote for votes in executor.map(query, range(VOTE_SHARDS)) for vote in votes]
+        self._tally = None
+
+class Tally(object):
+    """Votes of a poll by option"""
+
+    def __init__(self, counts, users_by_option_id):
+        # option_id -> number of votes
+        self.counts = counts
+        self.total = sum(counts.values())
+        # option_id -> list of (link, name). Links are made once per tally
+        self.voters = dict(
+            (option_id, [(user2link(u), user2name(u)) for u in users])
+            for option_id, users in users_by_option_id.items()
+        )
+        # options with votes, the most popular first
+        self.option_ids = sorted(counts, key=lambda option_id: counts[option_id], reverse=True)
+
+class Vote(Model):
+    """
+    A vote of a poll with sharded votes
+    """
+    class Meta:
+        table_name = DYNAMO_DB_VOTES_TABLE_NAME
+    # "<poll key>:<shard>". Votes of a poll are spread across VOTE_SHARDS
+    # partitions
+    shard_key = UnicodeAttribute(hash_key=True)
+    user_id = UnicodeAttribute(range_key=True)
+
+    option_id = NumberAttribute()
+    user = JSONAttribute()
+
+    @staticmethod
+    def get_shard_key(poll_key, user_id):
+        return "%s:%s" % (poll_key, int(user_id) % VOTE_SHARDS)
+
+# for transactions over both tables
+connection = Connection()
+
 
 def get_command_and_text(text):
     """split message into command and main text"""
@@ -0,0 +1,65 @@
+# Copyright 2020 Ivan Yelizariev <https://it-projects.info/team/yelizariev>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+"""Tests of poll message text. No AWS or telegram requests are made.
+
+    cd opinions-bot
+    python3 -m unittest test_lambda_function
+"""
+import os
+import re
+import unittest
+
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:ABCDEFabcdef0123456789ABCDEFabcdef0")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import lambda_function as bot  # noqa: E402
+
+
+def make_poll(question, votes=0, options=3):
+    poll = bot.Poll("-1:1", question=question, options=["Option %s" % i for i in range(options)])
+    for i in range(votes):
+        user_id = str(1000 + i)
+        poll.votes[user_id] = i % options
+        poll.users[user_id] = {"id": 1000 + i, "first_name": "User%s" % i}
+    return poll
+
+
+class TestPoll2Text(unittest.TestCase):
+
+    def assertFits(self, html):
+        # tags are not counted by telegram
+        text = re.sub("<[^>]+>", "", html)
+        self.assertLessEqual(bot.text_length(text), bot.MAX_MESSAGE_LENGTH)
+
+    def test_short_poll(self):
+        html = bot.poll2text(make_poll("Question?", votes=3))
+        self.assertTrue(html.startswith("<em>Question?</em>\n"))
+        self.assertIn("User0", html)
+
+    def test_many_voters(self):
+        html = bot.poll2text(make_poll("Question?", votes=2000))
+        self.assertFits(html)
+        self.assertTrue(html.startswith("<em>Question?</em>\n"))
+        self.assertIn(" more ", html)
+
+    def test_long_question_without_votes(self):
+        html = bot.poll2text(make_poll("Q" * 5000))
+        self.assertFits(html)
+        self.assertIn("…</em>", html)
+        self.assertIn(bot.NO_VOTES_YET, html)
+
+    def test_long_question_with_votes(self):
+        html = bot.poll2text(make_poll("Q" * 5000, votes=10))
+        self.assertFits(html)
+        self.assertIn("…</em>", html)
+        self.assertIn("%", html)
+
+    def test_long_question_with_surrogate_pairs(self):
+        # each emoji is 2 UTF-16 code units
+        html = bot.poll2text(make_poll(u"\U0001f600" * 3000, votes=1))
+        self.assertFits(html)
+        self.assertNotIn(u"�", html)
+
+
+if __name__ == "__main__":
+    unittest.main()
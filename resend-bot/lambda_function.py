@@ -5,6 +5,9 @@ import sys
 import os
 import logging
 import re
+import json
+import threading
+import time
 
 
 logger = logging.getLogger()
@@ -17,6 +20,115 @@ RESPONSE_200 = {
     "headers": { },
     "body": ""
 }
+
+METRICS = os.environ.get('METRICS') == 'True'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'chatops')
+# Max number of values per metric in a metrics record
+METRICS_MAX_VALUES = 100
+
+
+# BEGIN common/metrics.py
+class Metrics(object):
+    """Latency of calls made during an invocation, e.g. Bot API and DynamoDB calls.
+
+    The record is printed in CloudWatch Embedded Metric Format, so metrics
+    are extracted from the logs without extra requests. See
+    https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+
+    Each bot is deployed as a single file, so the class is copied to
+    lambda_function.py of every bot by common/sync.py. Edit common/metrics.py
+    instead of the copies.
+    """
+
+    def __init__(self, bot_name, enabled):
+        self.bot_name = bot_name
+        self.enabled = enabled
+        self.cold_start = True
+        self.start = time.time()
+        # name -> list of latencies in milliseconds
+        self.calls = {}
+        # calls may be made from other threads, e.g. workers of a pool
+        self.lock = threading.Lock()
+
+    def reset(self):
+        self.start = time.time()
+        self.calls = {}
+
+    def add(self, name, start):
+        if not self.enabled:
+            return
+        latency = (time.time() - start) * 1000
+        with self.lock:
+            self.calls.setdefault(name, []).append(latency)
+
+    def wrap(self, func, get_name):
+        """Returns func, that records its calls.
+
+        get_name computes the metric name from the call arguments. The call
+        is not recorded if the name is None.
+        """
+        def wrapper(*args, **kwargs):
+            name = get_name(*args, **kwargs)
+            if not name:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(name, start)
+        return wrapper
+
+    def emit(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            calls = dict(self.calls)
+        names = sorted(calls)
+        record = {
+            "_aws": {
+                "Timestamp": int(self.start * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [["Bot"]],
+                    "Metrics": [{"Name": "Duration", "Unit": "Milliseconds"}, {"Name": "ColdStart", "Unit": "Count"}]
+                    + [{"Name": name, "Unit": "Milliseconds"} for name in names]
+                    + [{"Name": name + ".count", "Unit": "Count"} for name in names],
+                }],
+            },
+            "Bot": self.bot_name,
+            "Duration": (time.time() - self.start) * 1000,
+            "ColdStart": int(self.cold_start),
+        }
+        for name in names:
+            record[name] = calls[name][:METRICS_MAX_VALUES]
+            record[name + ".count"] = len(calls[name])
+        self.cold_start = False
+        # EMF record has to be a separate line of the log
+        print(json.dumps(record), flush=True)
+# END common/metrics.py
+
+
+def telegram_metric_name(token, method_name, *args, **kwargs):
+    return 'telegram.' + method_name
+
+
+metrics = Metrics('resend-bot', METRICS)
+if METRICS:
+    telebot.apihelper._make_request = metrics.wrap(telebot.apihelper._make_request, telegram_metric_name)
+
+# Function, that returns response to telegram with a Bot API method to call.
+# It saves a request to telegram, but errors of the method are not reported.
+# Use it only for replies to the sender of the update.
+# See https://core.telegram.org/bots/api#making-requests-when-getting-updates
+def webhook_response(method, **params):
+    payload = dict((key, value) for key, value in params.items() if value is not None)
+    payload['method'] = method
+    return {
+        "statusCode": 200,
+        "headers": {"Content-Type": "application/json"},
+        "body": json.dumps(payload)
+    }
+
 MEDIA = {'sticker': 'send_sticker', 'voice': 'send_voice', 'video': 'send_video', 'document': 'send_document', 'video_note': 'send_video_note'}
 
 SYSTEM_EMPTY_MESSAGES = [
@@ -57,6 +169,13 @@ def get_formatted_text(text,entys):
         return f_text
 
 def lambda_handler(event, context):
+    metrics.reset()
+    try:
+        return handle_event(event, context)
+    finally:
+        metrics.emit()
+
+def handle_event(event, context):
     logger.debug("Event: \n%s", event)
     logger.debug("Context: \n%s", context)
     # READ webhook data
@@ -86,10 +205,9 @@ def lambda_handler(event, context):
     # Handle if user has an access to bot
     if ACCESS_BOT_LIST is not None:
         if user['id'] not in ACCESS_BOT_LIST:
-            bot.send_message(chat['id'], '<i>This is the private bot.\n</i>'
+            return webhook_response('sendMessage', chat_id=chat['id'], text='<i>This is the private bot.\n</i>'
             '<i>The good news is that you can deploy a similar bot for yourself:\n</i>'
-                r'https://chatops.readthedocs.io/en/latest/todo-bot/index.html',reply_to_message_id=message['message_id'], parse_mode='HTML')
-            return RESPONSE_200
+                r'https://chatops.readthedocs.io/en/latest/todo-bot/index.html',reply_to_message_id=message['message_id'], allow_sending_without_reply=True, parse_mode='HTML')
 
     def get_command_and_text(text):
         """split message into command and main text"""
@@ -103,12 +221,10 @@ def lambda_handler(event, context):
     command, main_text = get_command_and_text(message.get('text', ''))
 
     if command and command == '/thischat':
-        bot.send_message(chat['id'], chat['id'], reply_to_message_id=message['message_id'])
-        return RESPONSE_200
+        return webhook_response('sendMessage', chat_id=chat['id'], text=str(chat['id']), reply_to_message_id=message['message_id'], allow_sending_without_reply=True)
 
     if command and command == '/myid':
-        bot.send_message(chat['id'], user['id'], reply_to_message_id=message['message_id'])
-        return RESPONSE_200
+        return webhook_response('sendMessage', chat_id=chat['id'], text=str(user['id']), reply_to_message_id=message['message_id'], allow_sending_without_reply=True)
 
     original_chat = None
     original_message_id = None
@@ -131,13 +247,11 @@ def lambda_handler(event, context):
             if msg in message:
                 return RESPONSE_200
 
-        bot.send_message(chat['id'], "<i>Empty message is ignored</i>", reply_to_message_id=message['message_id'], parse_mode='HTML')
-        return RESPONSE_200
+        return webhook_response('sendMessage', chat_id=chat['id'], text="<i>Empty message is ignored</i>", reply_to_message_id=message['message_id'], allow_sending_without_reply=True, parse_mode='HTML')
 
     is_from_target_group = chat['id'] == TARGET_GROUP
     if is_from_target_group and not original_chat:
-        bot.send_message(chat['id'], "<i>At this chat you can only reply to the requests</i>", reply_to_message_id=message['message_id'], parse_mode='HTML')
-        return RESPONSE_200
+        return webhook_response('sendMessage', chat_id=chat['id'], text="<i>At this chat you can only reply to the requests</i>", reply_to_message_id=message['message_id'], allow_sending_without_reply=True, parse_mode='HTML')
 
     reply_chat = original_chat or TARGET_GROUP
 
@@ -178,6 +292,11 @@ def lambda_handler(event, context):
         photo = message.get('photo')[-1]
         bot.send_photo(reply_chat, photo['file_id'], caption=message.get('caption'))
 
-    bot.send_message(reply_chat, reply_text, reply_to_message_id=original_message_id or None, parse_mode='HTML')
+    # The message to another chat is not returned in the webhook response,
+    # because its errors would be lost there
+    try:
+        bot.send_message(reply_chat, reply_text, reply_to_message_id=int(original_message_id) if original_message_id else None, allow_sending_without_reply=True, parse_mode='HTML')
+    except telebot.apihelper.ApiException:
+        logger.exception('Error on sending message %s from chat %s to chat %s', message['message_id'], chat['id'], reply_chat)
 
     return RESPONSE_200
@@ -0,0 +1,164 @@
+# Copyright 2020 Ivan Yelizariev <https://it-projects.info/team/yelizariev>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+"""Export and import of todo-bot data.
+
+    python3 backup.py export > backup.jsonl
+    python3 backup.py import < backup.jsonl
+
+Tables are configured by the same environment variables as the bot, e.g.
+STORAGE and DYNAMODB_TABLE_TASK. Each line of the file is a JSON object:
+
+    {"table": "task", "item": {"id": {"N": "123"}, ...}}
+
+Items are kept in the format of the storage, i.e. the one produced by
+DynamodbItem.to_dict() and read by DynamodbItem.load_from_dict().
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import lambda_function as bot  # noqa: E402
+
+# Number of items per scan request
+SCAN_PAGE_SIZE = 1000
+
+logger = logging.getLogger('backup')
+
+
+def get_tables(names=None):
+    """Returns list of (name, item class)"""
+    tables = [
+        ('task', bot.Task),
+        ('user', bot.User),
+        ('messages', bot.TaskMessages),
+        ('search', bot.SearchTokenItem),
+    ]
+    # optional tables that are not configured
+    tables = [(name, cls) for name, cls in tables if cls.TABLE]
+    if names:
+        tables = [(name, cls) for name, cls in tables if name in names]
+    return tables
+
+
+def export_items(tables, output, segments):
+    """Write all items of the tables as JSON lines.
+
+    Each table is read by parallel segmented scan. Only a page per segment
+    is kept in memory.
+    """
+    lock = threading.Lock()
+
+    def scan_segment(name, cls, segment):
+        count = 0
+        start_key = None
+        while True:
+            items, start_key = bot.storage.scan(
+                cls.TABLE, cls.PARTITION_KEY,
+                segment=segment,
+                total_segments=segments,
+                page_size=SCAN_PAGE_SIZE,
+                start_key=start_key,
+            )
+            lines = ''.join(json.dumps({'table': name, 'item': item}, sort_keys=True) + '\n' for item in items)
+            with lock:
+                output.write(lines)
+            count += len(items)
+            if not start_key:
+                return count
+
+    counts = {}
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        futures = [
+            (name, executor.submit(scan_segment, name, cls, segment))
+            for name, cls in tables
+            for segment in range(segments)
+        ]
+        for name, future in futures:
+            counts[name] = counts.get(name, 0) + future.result()
+    output.flush()
+    return counts
+
+
+def import_items(tables, lines, workers):
+    """Put items from JSON lines to the tables.
+
+    Items are written by batches in parallel. Number of batches in memory is
+    limited, so the file may be of any size.
+    """
+    classes = dict(tables)
+    counts = {}
+    errors = []
+    # batches, that are submitted, but not written yet
+    slots = threading.BoundedSemaphore(workers * 2)
+
+    def write(cls, items):
+        try:
+            bot.storage.batch_put(cls.TABLE, cls.PARTITION_KEY, items)
+        except Exception as e:
+            logger.error('Error on writing to %s', cls.TABLE, exc_info=True)
+            errors.append(e)
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def submit(name, items):
+            slots.acquire()
+            counts[name] = counts.get(name, 0) + len(items)
+            executor.submit(write, classes[name], items)
+
+        buffers = {}
+        for line in lines:
+            if errors:
+                break
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            name = record['table']
+            if name not in classes:
+                # the table is not configured or not selected
+                continue
+            items = buffers.setdefault(name, [])
+            items.append(record['item'])
+            if len(items) >= bot.WRITE_BATCH_SIZE:
+                submit(name, items)
+                buffers[name] = []
+        for name, items in buffers.items():
+            if items and not errors:
+                submit(name, items)
+
+    if errors:
+        raise errors[0]
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('--file', help='File to write or read. Default is stdout or stdin')
+    parser.add_argument('--table', action='append', choices=['task', 'user', 'messages', 'search'],
+                        help='Table to export or import. Can be repeated. Default is all configured tables')
+    parser.add_argument('--segments', type=int, default=8, help='Number of parallel scans per table on export')
+    parser.add_argument('--workers', type=int, default=8, help='Number of parallel batch writes on import')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    tables = get_tables(args.table)
+    start = time.time()
+    if args.command == 'export':
+        output = open(args.file, 'w') if args.file else sys.stdout
+        counts = export_items(tables, output, args.segments)
+    else:
+        lines = open(args.file) if args.file else sys.stdin
+        counts = import_items(tables, lines, args.workers)
+    logger.info('%s: %s items in %.1f sec', args.command, counts, time.time() - start)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,108 +9,212 @@ import os
 import logging
 import re
 import boto3
+from botocore.client import BaseClient
 import json
+import time
+import copy
+import hashlib
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
 
 
 def lambda_handler(event, context):
-    global USERS
-    global message
-    global update
-    global chat
-    global user
+    metrics.reset()
+    try:
+        with Profiler(PROFILE_SLOWER_THAN, 'todo-bot'):
+            return handle_event(event, context)
+    finally:
+        metrics.emit()
+
+
+def handle_event(event, context):
     logger.debug("Event: \n%s", json.dumps(event))
     logger.debug("Context: \n%s", context)
     # Check for cron
     if event.get("source") == "aws.events":
-        return handle_cron(event)
+        return handle_cron(event, context)
+
+    # Check for batch of updates from a queue
+    if event.get("Records"):
+        return handle_batch(event["Records"])
 
     # READ webhook data
 
     # Object Update in json format.
     # See https://core.telegram.org/bots/api#update
     update = telebot.types.JsonDeserializable.check_json(event["body"])
+    return handle_update(update, webhook=True)
+
+
+def handle_batch(records):
+    """Handle batch of updates, e.g. from SQS queue.
 
+    Updates of different users are handled in parallel. Updates of the same
+    user are handled one by one in the order of the records, so batch of
+    forwarded messages is attached to a single task. Messages of the same
+    album are handled together.
+    """
+    user_queues = {}
+    for record in records:
+        update = json.loads(record['body'])
+        user_queues.setdefault(update2user_id(update), []).append((record, update))
+
+    def handle_user_queue(queue):
+        i = 0
+        while i < len(queue):
+            record, update = queue[i]
+            media_group_id = update2media_group_id(update)
+            j = i + 1
+            while media_group_id and j < len(queue) and update2media_group_id(queue[j][1]) == media_group_id:
+                j += 1
+            try:
+                handle_update(update, album=[u for r, u in queue[i + 1:j]])
+            except Exception:
+                logger.error("Error on handling update %s", update.get('update_id'), exc_info=True)
+                # Retry this and next updates of the user to keep the order
+                return [r['messageId'] for r, u in queue[i:]]
+            i = j
+        return []
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=UPDATE_WORKERS) as executor:
+        for message_ids in executor.map(handle_user_queue, user_queues.values()):
+            failed += message_ids
+    # See https://docs.aws.amazon.com/lambda/latest/dg/with-sqs.html#services-sqs-batchfailurereporting
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failed]}
+
+
+def handle_update(update, webhook=False, album=None):
+    """Handle telegram update.
+
+    If webhook is True, the last message may be returned in the response
+    to telegram server instead of sending it via separate request.
+
+    album is a list of next updates with messages of the same media group.
+    They are handled in the same UnitOfWork, so the messages are saved to
+    the task by a single write.
+    """
+    # User activity may be changed by another process at the same time. In
+    # that case the update is handled again with fresh data. Pending writes
+    # are committed before sending messages, so nothing is sent twice.
+    attempt = 0
+    while True:
+        uow = UnitOfWork()
+        outbox = Outbox(before_send=uow.commit)
+        try:
+            with uow:
+                for u in [update] + (album or []):
+                    dispatch_update(u, outbox)
+                uow.commit()
+        except (ConditionFailed, ItemNotFound) as e:
+            # messages that depend on failed writes are not sent
+            outbox.discard()
+            attempt += 1
+            if attempt >= ACTIVITY_RETRIES:
+                raise
+            logger.debug("Handling update %s again: %s", update.get('update_id'), e)
+            time.sleep(ACTIVITY_RETRY_DELAY * attempt)
+            continue
+        except:
+            outbox.flush()
+            raise
+        # wait until all messages are sent
+        return webhook_response(outbox.flush(webhook=webhook))
+
+
+def dispatch_update(update, outbox):
     # PARSE
     if update.get('callback_query'):
-        return handle_callback()
+        return handle_callback(update, outbox)
 
     message = update.get('message')
     if not message:
         return RESPONSE_200
 
-    chat = message.get('chat')
-    user = message.get('from')
-    text = message.get('text')
+    ctx = UpdateContext(update, message, message.get('chat'), message.get('from'), outbox)
+    text = ctx.message.get('text')
 
-    command, main_text = get_command_and_text(message.get('text', ''))
+    command, main_text = get_command_and_text(ctx.message.get('text', ''))
 
     if command:
-        return handle_command(command)
+        return handle_command(ctx, command)
 
     # Empty message
-    if not main_text and not any(message.get(key) for key in MEDIA) and not message.get('photo'):
-        send("<i>Empty message is ignored</i>", reply=True)
+    if not main_text and not any(ctx.message.get(key) for key in MEDIA) and not ctx.message.get('photo'):
+        send(ctx, "<i>Empty message is ignored</i>", reply=True)
         return RESPONSE_200
 
     # Check for recent activity
-    user_activity = User.load_by_id(user['id'], chat)
+    user_activity = User.load_by_id(ctx.user['id'], ctx.chat)
     activity = user_activity and user_activity.activity
     task = None
     task_from_me = None
     task_to_me = None
     if activity and activity != User.ACTIVITY_NONE:
-        # In case of concurency we raise error to force telegram resend the
-        # message when task is not saved by another process yet
+        # In case of concurency the task may be not saved by another process
+        # yet. ItemNotFound makes handle_update try again
         task = Task.load_by_id(user_activity.task_id, raise_if_not_found=True)
-        task_from_me = user['id'] == task.from_id
-        task_to_me = user['id'] == task.to_id
+        task_from_me = ctx.user['id'] == task.from_id
+        task_to_me = ctx.user['id'] == task.to_id
         if not (task_from_me or task_to_me):
-            bot.send_message(chat['id'], NOT_FOUND_MESSAGE, parse_mode='HTML')
+            ctx.outbox.add(ctx.chat['id'], bot.send_message, ctx.chat['id'], NOT_FOUND_MESSAGE, parse_mode='HTML')
             return RESPONSE_200
 
     add_message = False
 
-    if user_activity.activity == User.ACTIVITY_NEW_TASK:
-        telegram_delta = abs(message.get('date') - user_activity.telegram_unixtime)
-        logger.debug('telegram_delta=%s message\'s date: %s', telegram_delta, message.get('date'))
+    # next message of an album, that is already attached to the task
+    same_album = ctx.message.get('media_group_id') and ctx.message['media_group_id'] == user_activity.media_group_id
+
+    if user_activity.activity == User.ACTIVITY_NEW_TASK and same_album:
+        # telegram sends album as separate messages
+        add_message = True
+    elif user_activity.activity == User.ACTIVITY_NEW_TASK:
+        telegram_delta = abs(ctx.message.get('date') - user_activity.telegram_unixtime)
+        logger.debug('telegram_delta=%s message\'s date: %s', telegram_delta, ctx.message.get('date'))
         # Share button in iOS allows send couple of messages as a batch
-        second_message = len(task.messages) == 1
-        if (message.get('forward_from') or second_message) and telegram_delta < FORWARDING_DELAY:
+        second_message = task.msg_num == 1
+        if (ctx.message.get('forward_from') or second_message) and telegram_delta < FORWARDING_DELAY:
             # automatically attached series of message, but only forwarded or media messages
             add_message = True
-            send('<i>%s Message was automatically attached to </i>/t%s' % (EMOJI_AUTO_ATTACHED_MESSAGE, task.id))
-            if user_activity.telegram_unixtime < message.get('date'):
-                user_activity.telegram_unixtime = message.get('date')
+            if user_activity.telegram_unixtime < ctx.message.get('date'):
+                user_activity.telegram_unixtime = ctx.message.get('date')
                 user_activity.update_time()
+            send(ctx, '<i>%s Message was automatically attached to </i>/t%s' % (EMOJI_AUTO_ATTACHED_MESSAGE, task.id))
     elif user_activity.activity == User.ACTIVITY_ATTACHING:
         add_message = True
-        buttons = InlineKeyboardMarkup(row_width=1)
-        buttons.add(button_stop_attaching())
-        send('%s /t%s: <i>new message is attached. Send another message to attach</i>' % (EMOJI_ATTACHED_MESSAGE, task.id),
-             buttons)
+        if not same_album:
+            buttons = InlineKeyboardMarkup(row_width=1)
+            buttons.add(button_stop_attaching())
+            send(ctx, '%s /t%s: <i>new message is attached. Send another message to attach</i>' % (EMOJI_ATTACHED_MESSAGE, task.id),
+                 buttons)
 
     if add_message:
         # Update previous task instead of creating new one
-        task.add_and_update_messages(message)
+        task.add_and_update_messages(ctx.message)
+        user_activity.set_media_group(ctx.message)
     elif user_activity.activity == User.ACTIVITY_DESCRIPTION_UPDATING:
         # Update description
+        user_activity.activity = User.ACTIVITY_NONE
+        user_activity.update_activity()
+
         buttons = InlineKeyboardMarkup(row_width=1)
         buttons.add(
             button_my_tasks()
         )
-        send('<i>Description is updated for</i> /t%s' % task.id, buttons)
+        send(ctx, '<i>Description is updated for</i> /t%s' % task.id, buttons)
         old_description = task.description
         task.description = text
         task.update_description()
-        user_activity.activity = User.ACTIVITY_NONE
-        user_activity.update_activity()
 
         notify_another_user(
+            ctx,
             task,
             '<b>%s Task Description is updated by</b> %s\n\n<b>NEW:</b> %s\n\n<b>OLD:</b> %s' % (
                 EMOJI_NEW_DESCRIPTION_FROM_ANOTHER,
-                user2link(user),
+                user2link(ctx.user),
                 escape_html(task.description),
                 escape_html(old_description)
             )
@@ -118,75 +222,76 @@ def lambda_handler(event, context):
 
     elif user_activity.activity == User.ACTIVITY_ASSIGNING:
         # Update performer
+        user_activity.activity = User.ACTIVITY_NONE
+        user_activity.update_activity()
+
         m = re.match('.* u([0-9]+)$', text)
         if not m:
-            send('<i>Something went wrong. Try again</i>')
-            user_activity.activity = User.ACTIVITY_NONE
-            user_activity.update_activity()
+            send(ctx, '<i>Something went wrong. Try again</i>')
             return RESPONSE_200
         new_user_id = int(m.group(1))
         new_user_name = user_id2name(new_user_id)
 
         reply_text = '<i>%s is new performer for</i> /t%s' % (new_user_name, task.id)
         reply_markup = ReplyKeyboardRemove()
-        send(reply_text, reply_markup)
+        send(ctx, reply_text, reply_markup)
 
+        old_to_id = task.to_id
         task.to_id = new_user_id
-        task.update_assigned_to()
-
-        user_activity.activity = User.ACTIVITY_NONE
-        user_activity.update_activity()
+        task.update_assigned_to(old_to_id)
 
-        if user['id'] != new_user_id:
+        if ctx.user['id'] != new_user_id:
             # notify new user about the task
             new_user_activity = User.load_by_id(new_user_id)
             if new_user_activity.chat_id:
-                bot.send_message(
+                ctx.outbox.add(
+                    new_user_activity.chat_id,
+                    bot.send_message,
                     new_user_activity.chat_id,
                     '<i>%s You got new task from</i> %s:\n/t%s\n%s' % (
                         EMOJI_NEW_TASK_FROM_ANOTHER,
-                        user2link(user),
+                        user2link(ctx.user),
                         task.id,
                         escape_html(task.description),
                     ),
                     parse_mode='HTML'
                 )
 
-    elif str(user['id']) not in USERS:
-        send('<i>It\'s a private bot, sorry. But you can create new one for yourself: </i> https://chatops.readthedocs.io/en/latest/todo-bot/index.html')
+    elif str(ctx.user['id']) not in USERS:
+        send(ctx, '<i>It\'s a private bot, sorry. But you can create new one for yourself: </i> https://chatops.readthedocs.io/en/latest/todo-bot/index.html')
     else:
         # Just create new task
-        task_id = update['update_id'] - MIN_UPDATE_ID
-        buttons = task_bottom_buttons(task=None, task_id=task_id)
-        send("<i>{emoji} Task created:</i> /t{task_id}".format(emoji=EMOJI_NEW_TASK, task_id=task_id),
-             buttons)
+        task_id = ctx.update['update_id'] - MIN_UPDATE_ID
         # It's important to update activity first, because second message in a
-        # batch can be proceeded by another process, so we have to update activity ASAP.
-        # Though, there is no gurantee that this process will do it faster.
-        # A strong solution is avoiding concurency via Lambda config "Reserve concurrency = 1"
-        # OR by making FIFO queue per user
-        # OR using lock in user activity
+        # batch can be proceeded by another process. The write fails if
+        # another process has changed the activity, and then the message is
+        # handled again to be attached to the task of another process.
         user_activity.activity = User.ACTIVITY_NEW_TASK
         user_activity.task_id = task_id
-        user_activity.telegram_unixtime = message.get('date')
+        user_activity.telegram_unixtime = ctx.message.get('date')
         user_activity.update_activity_task_time()
+        user_activity.set_media_group(ctx.message)
 
-        task = Task(task_id, user_id=user['id'])
-        task.add_message(message)
-        task.description = message2description(message)
-        task.telegram_unixtime = message.get('date')
-        task.next_reminder = message.get('date') + 24 * 3600 * REMINDER_DAYS
+        task = Task(task_id, user_id=ctx.user['id'])
+        task.add_message(ctx.message)
+        task.description = message2description(ctx.message, ctx.user)
+        task.telegram_unixtime = ctx.message.get('date')
+        task.next_reminder = ctx.message.get('date') + 24 * 3600 * REMINDER_DAYS
         task.update()
+
+        buttons = task_bottom_buttons(task=None, task_id=task_id)
+        send(ctx, "<i>{emoji} Task created:</i> /t{task_id}".format(emoji=EMOJI_NEW_TASK, task_id=task_id),
+             buttons)
     return RESPONSE_200
 
 
-def handle_command(command):
+def handle_command(ctx, command):
     user_activity = None
     # commands without_activity
     if command == '/start':
-        send('<i>Send or Forward a message to create new task</i>')
         # create User record (see User.load_by_id method)
-        user_activity = User.load_by_id(user['id'], chat)
+        user_activity = User.load_by_id(ctx.user['id'], ctx.chat)
+        send(ctx, '<i>Send or Forward a message to create new task</i>')
     elif command == '/users':
         # Apparently, there is no way to get list of users
         pass
@@ -203,99 +308,148 @@ def handle_command(command):
         #     result[user['id']] = user2name(user_dict)
         # reply_text = json.dumps(result)
     elif command == '/myid':
-        send(json.dumps({user['id']: user2name(user)}))
+        send(ctx, json.dumps({ctx.user['id']: user2name(ctx.user)}))
     elif command == '/update_id':
-        send(update['update_id'])
+        send(ctx, ctx.update['update_id'])
     elif command in ['/mytasks', '/tasks_from_me']:
-        # TODO: make cache for /mytasks
         to_me = command == '/mytasks'
-        com_tasks(to_me)
+        com_tasks(ctx, to_me)
+    elif command == '/search':
+        com_search(ctx)
     elif re.match('/t[0-9]+', command):
         task_id = int(command[2:])
-        com_print_task(task_id)
+        com_print_task(ctx, task_id)
     else:
-        user_activity = User.load_by_id(user['id'], chat)
+        user_activity = User.load_by_id(ctx.user['id'], ctx.chat)
 
     if command in ['/stop_attaching', '/cancel']:
         cancel = command == '/cancel'
-        com_cancel(user_activity, cancel)
+        com_cancel(ctx, user_activity, cancel)
     elif command.startswith('/attach'):
         task_id = int(command[len('/attach'):])
-        com_attach(user_activity, task_id)
+        com_attach(ctx, user_activity, task_id)
     elif command.startswith('/assign'):
         task_id = int(command[len('/assign'):])
-        com_assign(user_activity, task_id)
+        com_assign(ctx, user_activity, task_id)
     return RESPONSE_200
 
 
-def handle_callback():
+def handle_callback(update, outbox):
     callback_query = update.get('callback_query')
     callback = decode_callback(callback_query.get('data'))
     task_id = callback.get('task_id')
     action = callback.get('action')
-    global message
     message = callback_query.get('message')
     if not message:
         return RESPONSE_200
 
-    global chat
-    chat = message.get('chat')
-
     # message's "from" is Bot User, not the User who clicked the inline button
-    global user
-    user = callback_query.get('from')
+    ctx = UpdateContext(update, message, message.get('chat'), callback_query.get('from'), outbox)
 
     user_activity = None
     # actions without activity
     if action == ACTION_UPDATE_TASK_STATE:
         # TODO: update buttons where is was clicked
-        com_update_task_state(task_id, callback['task_state'])
+        com_update_task_state(ctx, task_id, callback['task_state'])
     elif action == ACTION_MY_TASKS:
-        com_tasks(header='<b>My Tasks</b>', reply=False)
+        com_tasks(ctx, header='<b>My Tasks</b>', reply=False)
     elif action == ACTION_TASKS_FROM_ME:
-        com_tasks(to_me=False, header='<b>Tasks From Me</b>', reply=False)
+        com_tasks(ctx, to_me=False, header='<b>Tasks From Me</b>', reply=False)
     elif action == ACTION_TASK:
-        com_print_task(task_id)
+        com_print_task(ctx, task_id)
     else:
-        user_activity = User.load_by_id(user['id'], chat)
+        user_activity = User.load_by_id(ctx.user['id'], ctx.chat)
 
     if action == ACTION_UPDATE_DESCRIPTION:
-        com_update_description(user_activity, task_id)
+        com_update_description(ctx, user_activity, task_id)
     elif action == ACTION_UPDATE_ASSIGNED_TO:
-        com_update_assigned_to(user_activity, task_id)
+        com_update_assigned_to(ctx, user_activity, task_id)
     elif action == ACTION_ATTACH_MESSAGES:
-        com_attach(user_activity, task_id)
+        com_attach(ctx, user_activity, task_id)
     elif action in [ACTION_CANCEL, ACTION_STOP]:
         cancel = action == ACTION_CANCEL
-        com_cancel(user_activity, cancel, reply=False)
+        com_cancel(ctx, user_activity, cancel, reply=False)
 
     return RESPONSE_200
 
 
-def handle_cron(event):
+def handle_cron(event, context=None):
     # Time example "2019-04-16T09:45:07Z"
     TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
-    NOTIFICATION_TITLE = u'\u2757\ufe0f' + "There are some old tasks. Please, either <b>do</b> them, <b>relocate</b> somewhere or mark as <b>canceled</b>."
     time = event['time']
     dt = datetime.strptime(time, TIME_FORMAT)
-    unixtime = (dt - datetime(1970, 1, 1)).total_seconds()
+    unixtime = int((dt - datetime(1970, 1, 1)).total_seconds())
+    next_reminder = unixtime + 24 * 3600 * REMINDER_DAYS
 
-    for user_id, user_name in USERS.items():
-        user_tasks = list(Task.get_tasks_to_remind(user_id, unixtime))
-        has_tasks = len(user_tasks)
-        if has_tasks:
-            user_activity = User.load_by_id(user_id)
-            try:
-                bot.send_message(
-                    user_activity.chat_id,
-                    NOTIFICATION_TITLE,
-                    parse_mode='HTML',
-                )
-            except:
-                # chat not found?
-                continue
+    # Lambda retries failed cron invocations with the same event, so the
+    # checkpoint allows to skip users, who already got reminders
+    checkpoint = CronCheckpoint.load_by_id(CronCheckpoint.CHECKPOINT_ID)
+    if checkpoint.unixtime != unixtime:
+        checkpoint.unixtime = unixtime
+        checkpoint.done_users = ''
+    done_users = checkpoint.get_done_users()
+
+    lock = threading.Lock()
+    skipped_users = []
+
+    def has_time():
+        return not context or context.get_remaining_time_in_millis() >= CRON_TIME_RESERVE
+
+    def remind(user_id):
+        try:
+            complete = remind_user(user_id, unixtime, next_reminder, has_time)
+        except Exception:
+            # e.g. the user has blocked the bot. Reminders that are sent are
+            # saved, the rest are sent next time
+            logger.error("Error on reminding user %s", user_id, exc_info=True)
+            return
+        with lock:
+            if not complete:
+                # not enough time. Leave the user for the next attempt
+                skipped_users.append(user_id)
+                return
+            done_users.append(user_id)
+            checkpoint.set_done_users(done_users)
+            checkpoint.update()
+
+    user_ids = [user_id for user_id in USERS if user_id not in done_users]
+    with ThreadPoolExecutor(max_workers=CRON_WORKERS) as executor:
+        # Each user has own chat, so messages are sent in parallel across
+        # chats, but in order inside each chat
+        list(executor.map(remind, user_ids))
+
+    if skipped_users:
+        # Raise error to make Lambda retry the invocation
+        raise Exception("Cron is interrupted by timeout. Users to be reminded on retry: %s" % skipped_users)
+    return RESPONSE_200
+
+
+def remind_user(user_id, unixtime, next_reminder, has_time):
+    """Send reminders to a single user.
+
+    Each reminded task gets next_reminder, even if sending of the rest
+    fails, so a retry doesn't remind it again. Returns False if there is no
+    time left to remind all tasks.
+    """
+    NOTIFICATION_TITLE = u'\u2757\ufe0f' + "There are some old tasks. Please, either <b>do</b> them, <b>relocate</b> somewhere or mark as <b>canceled</b>."
+    user_tasks = []
+    try:
+        # send reminders as soon as pages are received
+        for task in Task.get_tasks_to_remind(user_id, unixtime):
+            if not has_time():
+                return False
+            if not user_tasks:
+                user_activity = User.load_by_id(user_id)
+                try:
+                    bot.send_message(
+                        user_activity.chat_id,
+                        NOTIFICATION_TITLE,
+                        parse_mode='HTML',
+                    )
+                except:
+                    # chat not found?
+                    return True
 
-        for task in user_tasks:
             # FIXME: the code is copy-pasted
             reply_text = '%s\n\n%s' % (
                 escape_html(task.description),
@@ -308,126 +462,164 @@ def handle_cron(event):
                 parse_mode='HTML',
                 reply_markup=reply_markup
             )
+            task.next_reminder = next_reminder
+            user_tasks.append(task)
 
-            task.next_reminder = unixtime + 24 * 3600 * REMINDER_DAYS
-            task.update_next_reminder()
-
-        if has_tasks:
+        if user_tasks:
             bot.send_message(
                 user_activity.chat_id,
                 NOTIFICATION_TITLE,
                 parse_mode='HTML',
             )
-    return RESPONSE_200
+        return True
+    finally:
+        # A task that is closed meanwhile must not get remind_at back, which
+        # would return it to REMIND_INDEX
+        Task.batch_update(user_tasks, ['next_reminder', 'remind_at'], expected={'task_state': Task.elem_to_num(TASK_STATE_TODO)})
 
 
-def com_update_assigned_to(user_activity, task_id):
-    buttons = InlineKeyboardMarkup(row_width=1)
-    buttons.add(button_cancel())
-    send('/t%s' % task_id, assign_keyboard())
-    send('<i>Send new performer</i>', buttons)
-
+def com_update_assigned_to(ctx, user_activity, task_id):
     user_activity.activity = User.ACTIVITY_ASSIGNING
     user_activity.task_id = task_id
     user_activity.update_activity_and_task()
 
-
-def com_update_description(user_activity, task_id):
     buttons = InlineKeyboardMarkup(row_width=1)
     buttons.add(button_cancel())
-    send('/t%s: <i>Send new description or click</i> /cancel' % task_id, buttons)
+    send(ctx, '/t%s' % task_id, assign_keyboard())
+    send(ctx, '<i>Send new performer</i>', buttons)
+
+
+def com_update_description(ctx, user_activity, task_id):
     user_activity.activity = User.ACTIVITY_DESCRIPTION_UPDATING
     user_activity.task_id = task_id
     user_activity.update_activity_and_task()
+    buttons = InlineKeyboardMarkup(row_width=1)
+    buttons.add(button_cancel())
+    send(ctx, '/t%s: <i>Send new description or click</i> /cancel' % task_id, buttons)
 
 
-def com_update_task_state(task_id, task_state):
+def com_update_task_state(ctx, task_id, task_state):
     task = Task.load_by_id(task_id)
 
     if task.task_state != task_state:
-        if user['id'] in [task.from_id, task.to_id]:
+        if ctx.user['id'] in [task.from_id, task.to_id]:
 
             task.task_state = task_state
             task.update_task_state()
-            update_task_message_text(task,message['message_id'], user['id'])
+            update_task_message_text(ctx, task, ctx.message['message_id'])
 
             notify_another_user(
+                    ctx,
                     task,
                     '<b>%s Task State is changed by</b> %s\n\n%s' % (
                     EMOJI_NEW_STATE_FROM_ANOTHER,
-                    user2link(user),
+                    user2link(ctx.user),
                     escape_html(task.description)
                     )
                     )
         else:
-            send(NOT_FOUND_MESSAGE)
+            send(ctx, NOT_FOUND_MESSAGE)
 
 
-def com_assign(user_activity, task_id):
-    reply_markup = assign_keyboard()
-    send('<i>Select new performer or click /cancel</i>', reply_markup)
+def com_assign(ctx, user_activity, task_id):
     user_activity.activity = User.ACTIVITY_ASSIGNING
     user_activity.task_id = task_id
     user_activity.update_activity_and_task()
+    reply_markup = assign_keyboard()
+    send(ctx, '<i>Select new performer or click /cancel</i>', reply_markup)
 
 
-def com_attach(user_activity, task_id):
-    buttons = InlineKeyboardMarkup()
-    buttons.add(button_stop_attaching())
-    send('<i>%s Send message to attach</i>' % EMOJI_SEND_MESSAGE_TO_ATTACH, buttons)
+def com_attach(ctx, user_activity, task_id):
     user_activity.activity = User.ACTIVITY_ATTACHING
     user_activity.task_id = task_id
     user_activity.update_activity_and_task()
+    buttons = InlineKeyboardMarkup()
+    buttons.add(button_stop_attaching())
+    send(ctx, '<i>%s Send message to attach</i>' % EMOJI_SEND_MESSAGE_TO_ATTACH, buttons)
+
 
+def com_cancel(ctx, user_activity, cancel=True, reply=True):
+    user_activity.activity = User.ACTIVITY_NONE
+    user_activity.update_activity()
 
-def com_cancel(user_activity, cancel=True, reply=True):
     if cancel:
         reply_text = 'Request for input is canceled'
     else:
         reply_text = 'Stopped'
-    send('%s <i>%s</i>' % (EMOJI_ATTACHING_STOPPED, reply_text), ReplyKeyboardRemove(), reply=reply)
+    send(ctx, '%s <i>%s</i>' % (EMOJI_ATTACHING_STOPPED, reply_text), ReplyKeyboardRemove(), reply=reply)
 
     buttons = InlineKeyboardMarkup(row_width=1)
     buttons.add(button_my_tasks())
     reply_text = '<i>Send a message to create new Task</i>'
-    send(reply_text, buttons, reply=False)
-    user_activity.activity = User.ACTIVITY_NONE
-    user_activity.update_activity()
+    send(ctx, reply_text, buttons, reply=False)
 
 
-def com_tasks(to_me=True, header=None, reply=True):
-    user_id = user['id']
-    task_list = Task.get_tasks(
-        to_me=to_me,
-        user_id=user_id,
-        task_state=TASK_STATE_TODO
-    )
+def com_tasks(ctx, to_me=True, header=None, reply=True):
+    user_id = ctx.user['id']
     if header:
-        send(header, reply_markup=ReplyKeyboardRemove(), reply=reply)
+        send(ctx, header, reply_markup=ReplyKeyboardRemove(), reply=reply)
 
-    not_found = True
-    for task in task_list:
-        # The problem with buttons is that when you click them, telegram doesn't scroll down on new messages
-        # buttons = InlineKeyboardMarkup(row_width=1)
-        # buttons.add(button_task(task, user_id))
+    def send_card(task):
         reply_text = '%s\n\n%s' % (
             escape_html(task.description),
             task_summary(task, user_id)
         )
-        reply_markup = task_state_keyboard(task, row_width=4)
-        send(reply_text, reply=False, reply_markup=reply_markup)
-        not_found = False
+        # The problem with buttons is that when you click them, telegram doesn't scroll down on new messages
+        # buttons = InlineKeyboardMarkup(row_width=1)
+        # buttons.add(button_task(task, user_id))
+        # Only TODO tasks are listed
+        reply_markup = task_state_keyboard(None, task_id=task.id, row_width=4)
+        send(ctx, reply_text, reply=False, reply_markup=reply_markup)
+
+    # Tasks are cached rather than rendered cards, since cards show time
+    # relative to now
+    tasks = tasks_cache.get(user_id, to_me)
+    if tasks is not None:
+        for d in tasks:
+            send_card(Task.load_from_dict(d))
+    else:
+        tasks = []
+        task_list = Task.get_tasks(
+            to_me=to_me,
+            user_id=user_id,
+            task_state=TASK_STATE_TODO
+        )
+        # send cards as soon as pages are received
+        for task in task_list:
+            send_card(task)
+            tasks.append(task.summary_dict())
+        tasks_cache.set(user_id, to_me, tasks)
+
+    if not tasks:
+        send(ctx, "<i>Tasks are not found</i>", reply=reply)
 
-    if not_found:
-        send("<i>Tasks are not found</i>", reply=reply)
 
+def com_search(ctx):
+    user_id = ctx.user['id']
+    command, text = get_command_and_text(ctx.message.get('text', ''))
+    if not search_index.enabled:
+        send(ctx, '<i>Search is not enabled</i>')
+        return
+    if not search_tokens(text):
+        send(ctx, '<i>Usage:</i> /search WORDS')
+        return
 
-def com_print_task(task_id, check_rights=True):
+    tasks = search_index.search(user_id, text, SEARCH_RESULTS)
+    if not tasks:
+        send(ctx, "<i>Tasks are not found</i>")
+        return
+    send(ctx, '\n\n'.join(
+        '%s\n%s' % (escape_html(shorten(task.description, SEARCH_DESCRIPTION_LENGTH)), task_summary(task, user_id))
+        for task in tasks
+    ))
+
+
+def com_print_task(ctx, task_id, check_rights=True):
     task = Task.load_by_id(task_id)
-    user_id = user['id']
+    user_id = ctx.user['id']
     if not user_id or user_id not in [task.from_id, task.to_id]:
         logger.info('No access to task %s for user %s, because from_id=%s, to_id=%s', task_id, user_id, task.from_id, task.to_id)
-        bot.send_message(chat['id'], NOT_FOUND_MESSAGE, parse_mode='HTML', reply_markup=ReplyKeyboardRemove())
+        ctx.outbox.add(ctx.chat['id'], bot.send_message, ctx.chat['id'], NOT_FOUND_MESSAGE, parse_mode='HTML', reply_markup=ReplyKeyboardRemove())
         return False
 
     header = escape_html(task.description)
@@ -438,34 +630,33 @@ def com_print_task(task_id, check_rights=True):
         button_update_description(task_id),
     )
 
-    send(header, reply=True, reply_markup=buttons)
-    for from_chat_id, msg_id in task.messages:
-        try:
-            bot.forward_message(
-                chat['id'],
-                from_chat_id=from_chat_id,
-                message_id=msg_id,
-            )
-        except ApiException as e:
-            res = e.result.json()
-            if res['description'] == "Bad Request: message to forward not found":
-                send("Message is not found. The sender has probably deleted bot's chat history: msg_id=%s" % msg_id)            
+    send(ctx, header, reply=True, reply_markup=buttons)
+    forward_messages(ctx, task.messages)
 
     buttons = task_bottom_buttons(task)
-    bot.send_message(chat['id'], "/t{task_id}".format(task_id=task_id), reply_markup=buttons, parse_mode='HTML')
+    ctx.outbox.add(ctx.chat['id'], bot.send_message, ctx.chat['id'], "/t{task_id}".format(task_id=task_id), reply_markup=buttons, parse_mode='HTML')
 
 
-def  update_task_message_text(task,message,user):
+def  update_task_message_text(ctx, task, message_id):
     header = escape_html(task.description)
     header += '\n\n'
-    header += task_summary(task, user)
+    header += task_summary(task, ctx.user['id'])
 
     if task.task_state==TASK_STATE_TODO:
         buttons = task_bottom_buttons(task,task_id = None)
     else:
         buttons = task_state_keyboard(task, row_width=4)
 
-    bot.edit_message_text(text=header, chat_id = chat['id'], message_id = message, parse_mode='HTML', reply_markup=buttons )
+    # https://core.telegram.org/bots/api#editmessagetext
+    payload = {
+        'method': 'editMessageText',
+        'chat_id': ctx.chat['id'],
+        'message_id': message_id,
+        'text': header,
+        'parse_mode': 'HTML',
+        'reply_markup': json.loads(buttons.to_json()),
+    }
+    ctx.outbox.add_inline(ctx.chat['id'], payload, bot.edit_message_text, header, ctx.chat['id'], message_id, parse_mode='HTML', reply_markup=buttons)
 
 #########################
 # Buttons and Keyboards #
@@ -576,30 +767,89 @@ NOT_FOUND_MESSAGE = "<i>Task doesn't exist or you don't have access to it</i>"
 
 FROM_INDEX = 'from_id-task_state-index'
 TO_INDEX = 'to_id-task_state-index'
+# sparse index: only TODO tasks have remind_at
+REMIND_INDEX = 'to_id-remind_at-index'
+INDEX_KEYS = {
+    FROM_INDEX: ['from_id', 'task_state'],
+    TO_INDEX: ['to_id', 'task_state'],
+    REMIND_INDEX: ['to_id', 'remind_at'],
+}
+# Number of items to evaluate per query request. Smaller pages allow to
+# start sending messages before all tasks are read
+QUERY_PAGE_SIZE = 50
+# max number of messages in a single forwardMessages request
+FORWARD_BATCH_SIZE = 100
 
 # READ environment variables
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
 USERS = os.environ.get('USERS', '{}')
 if USERS:
     USERS = dict(json.loads(USERS))
-DYNAMODB_TABLE_TASK = os.environ.get('DYNAMODB_TABLE_TASK')
-DYNAMODB_TABLE_USER = os.environ.get('DYNAMODB_TABLE_USER')
+# dynamodb (default), memory or sqlite:/path/to/file.db
+STORAGE = os.environ.get('STORAGE', 'dynamodb')
+DYNAMODB_TABLE_TASK = os.environ.get('DYNAMODB_TABLE_TASK', 'todo-bot-task')
+DYNAMODB_TABLE_USER = os.environ.get('DYNAMODB_TABLE_USER', 'todo-bot-user')
+DYNAMODB_TABLE_CACHE = os.environ.get('DYNAMODB_TABLE_CACHE')
+DYNAMODB_TABLE_SEARCH = os.environ.get('DYNAMODB_TABLE_SEARCH')
+DYNAMODB_TABLE_MESSAGES = os.environ.get('DYNAMODB_TABLE_MESSAGES')
+SEARCH_RESULTS = int(os.environ.get('SEARCH_RESULTS', 10))
+TASKS_CACHE_TTL = int(os.environ.get('TASKS_CACHE_TTL', 600 if DYNAMODB_TABLE_CACHE else 0))
 LOG_LEVEL = os.environ.get('LOG_LEVEL')
 MIN_UPDATE_ID = int(os.environ.get('MIN_UPDATE_ID', 0))
 FORWARDING_DELAY = int(os.environ.get('FORWARDING_DELAY', 3))
 REMINDER_DAYS = int(os.environ.get('REMINDER_DAYS', 14))
+# read due tasks from REMIND_INDEX instead of filtering all TODO tasks
+USE_REMIND_INDEX = os.environ.get('USE_REMIND_INDEX') == 'True'
+CRON_WORKERS = int(os.environ.get('CRON_WORKERS', 8))
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', 8))
+SEND_WORKERS = int(os.environ.get('SEND_WORKERS', 8))
+WRITE_WORKERS = int(os.environ.get('WRITE_WORKERS', 8))
+METRICS = os.environ.get('METRICS') == 'True'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'chatops')
+PROFILE_SLOWER_THAN = int(os.environ.get('PROFILE_SLOWER_THAN', 0))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '/tmp')
+# how much times to handle an update, when user activity is changed by another process
+ACTIVITY_RETRIES = 5
+ACTIVITY_RETRY_DELAY = 0.2  # seconds
+# milliseconds to keep for saving the cron progress before Lambda timeout
+CRON_TIME_RESERVE = int(os.environ.get('CRON_TIME_RESERVE', 5000))
+# max number of items in a single batch_write_item request
+WRITE_BATCH_SIZE = 25
+# max number of items in a single transact_write_items request
+TRANSACT_MAX_ITEMS = 100
+# max number of keys in a single batch_get_item request
+READ_BATCH_SIZE = 100
+# seconds to wait before writing unprocessed items of a batch again. It's
+# doubled on each attempt
+BATCH_RETRY_DELAY = 0.05
+BATCH_RETRY_MAX_DELAY = 5
+# max number of words of a task description to index for search
+SEARCH_MAX_TOKENS = 20
+# task ids per page of search index. Ids are shared by all users, so a page
+# has at most that many tasks, which keeps it far below the 400 KB item limit
+SEARCH_PAGE_SIZE = 10000
+SEARCH_DESCRIPTION_LENGTH = 100
+# number of attached messages per item of DYNAMODB_TABLE_MESSAGES
+MESSAGES_CHUNK_SIZE = 200
+# id of a chunk is TASK_ID * MESSAGES_CHUNKS_MAX + CHUNK_NUMBER
+MESSAGES_CHUNKS_MAX = 1000
+# Max number of values per metric in a metrics record
+METRICS_MAX_VALUES = 100
+# Seconds between samples of the profiler
+PROFILE_INTERVAL = 0.01
+# Number of hot functions to log for a slow invocation
+PROFILE_TOP = 20
 
 logger = logging.getLogger()
 if LOG_LEVEL:
     logger.setLevel(getattr(logging, LOG_LEVEL))
 
 
-dynamodb = boto3.client('dynamodb')
 bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
-update = None
-message = None
-chat = None
-user = None
+# sends messages of Outbox
+send_executor = ThreadPoolExecutor(max_workers=SEND_WORKERS)
+# writes independent items, e.g. of DynamodbItem.batch_update and SearchIndex
+write_executor = ThreadPoolExecutor(max_workers=WRITE_WORKERS)
 
 RESPONSE_200 = {
     "statusCode": 200,
@@ -662,23 +912,407 @@ TASK_STATE_TO_HTML = {
 }
 
 
+###########
+# Metrics #
+###########
+# BEGIN common/metrics.py
+class Metrics(object):
+    """Latency of calls made during an invocation, e.g. Bot API and DynamoDB calls.
+
+    The record is printed in CloudWatch Embedded Metric Format, so metrics
+    are extracted from the logs without extra requests. See
+    https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+
+    Each bot is deployed as a single file, so the class is copied to
+    lambda_function.py of every bot by common/sync.py. Edit common/metrics.py
+    instead of the copies.
+    """
+
+    def __init__(self, bot_name, enabled):
+        self.bot_name = bot_name
+        self.enabled = enabled
+        self.cold_start = True
+        self.start = time.time()
+        # name -> list of latencies in milliseconds
+        self.calls = {}
+        # calls may be made from other threads, e.g. workers of a pool
+        self.lock = threading.Lock()
+
+    def reset(self):
+        self.start = time.time()
+        self.calls = {}
+
+    def add(self, name, start):
+        if not self.enabled:
+            return
+        latency = (time.time() - start) * 1000
+        with self.lock:
+            self.calls.setdefault(name, []).append(latency)
+
+    def wrap(self, func, get_name):
+        """Returns func, that records its calls.
+
+        get_name computes the metric name from the call arguments. The call
+        is not recorded if the name is None.
+        """
+        def wrapper(*args, **kwargs):
+            name = get_name(*args, **kwargs)
+            if not name:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(name, start)
+        return wrapper
+
+    def emit(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            calls = dict(self.calls)
+        names = sorted(calls)
+        record = {
+            "_aws": {
+                "Timestamp": int(self.start * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [["Bot"]],
+                    "Metrics": [{"Name": "Duration", "Unit": "Milliseconds"}, {"Name": "ColdStart", "Unit": "Count"}]
+                    + [{"Name": name, "Unit": "Milliseconds"} for name in names]
+                    + [{"Name": name + ".count", "Unit": "Count"} for name in names],
+                }],
+            },
+            "Bot": self.bot_name,
+            "Duration": (time.time() - self.start) * 1000,
+            "ColdStart": int(self.cold_start),
+        }
+        for name in names:
+            record[name] = calls[name][:METRICS_MAX_VALUES]
+            record[name + ".count"] = len(calls[name])
+        self.cold_start = False
+        # EMF record has to be a separate line of the log
+        print(json.dumps(record), flush=True)
+# END common/metrics.py
+
+
+def telegram_metric_name(token, method_name, *args, **kwargs):
+    return 'telegram.' + method_name
+
+
+def dynamodb_metric_name(client, operation_name, api_params):
+    if client.meta.service_model.service_name == 'dynamodb':
+        return 'dynamodb.' + operation_name
+
+
+metrics = Metrics('todo-bot', METRICS)
+if METRICS:
+    # Nothing is wrapped, when metrics are disabled
+    telebot.apihelper._make_request = metrics.wrap(telebot.apihelper._make_request, telegram_metric_name)
+    BaseClient._make_api_call = metrics.wrap(BaseClient._make_api_call, dynamodb_metric_name)
+
+
+############
+# Profiler #
+############
+# BEGIN common/profiler.py
+class Profiler(object):
+    """Sampling profiler of a slow invocation.
+
+    A background thread samples stacks of all threads, so time spent in
+    worker threads and in waiting for network is visible too. Samples are
+    kept only if the invocation takes longer than slower_than milliseconds.
+    Then they are written to a file in collapsed stack format, which is read
+    by flame graph tools, e.g. https://github.com/brendangregg/FlameGraph
+
+    Each bot is deployed as a single file, so the class is copied to
+    lambda_function.py of the bots by common/sync.py. Edit common/profiler.py
+    instead of the copies.
+    """
+
+    def __init__(self, slower_than, name):
+        self.slower_than = slower_than
+        self.name = name
+        # collapsed stack -> number of samples
+        self.samples = {}
+        self.thread = None
+
+    def __enter__(self):
+        if not self.slower_than:
+            return self
+        self.start = time.time()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if not self.thread:
+            return
+        self.stopped.set()
+        self.thread.join()
+        duration = (time.time() - self.start) * 1000
+        if duration < self.slower_than:
+            return
+        path = os.path.join(PROFILE_DIR, "%s-%s.folded" % (self.name, int(self.start * 1000)))
+        with open(path, "w") as f:
+            for stack, count in self.samples.items():
+                f.write("%s %s\n" % (stack, count))
+        logger.warning("Slow invocation: %.0f ms. Profile: %s. Hot functions (self, total samples):\n%s",
+                       duration, path, "\n".join("%s %s %s" % row for row in self.top(PROFILE_TOP)))
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(PROFILE_INTERVAL):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or self.is_idle_worker(frame):
+                    continue
+                stack = []
+                while frame:
+                    code = frame.f_code
+                    stack.append("%s (%s:%s)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stack = ";".join(reversed(stack))
+                self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def top(self, limit):
+        """Returns list of (function, self samples, total samples)"""
+        own = {}
+        total = {}
+        for stack, count in self.samples.items():
+            functions = stack.split(";")
+            own[functions[-1]] = own.get(functions[-1], 0) + count
+            # recursive functions are counted once per sample
+            for func in set(functions):
+                total[func] = total.get(func, 0) + count
+        rows = sorted(own.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [(func, count, total[func]) for func, count in rows]
+
+    @staticmethod
+    def is_idle_worker(frame):
+        """Whether the thread is a worker of ThreadPoolExecutor waiting for a job"""
+        code = frame.f_code
+        return code.co_name == "_worker" and code.co_filename.endswith(os.path.join("concurrent", "futures", "thread.py"))
+# END common/profiler.py
+
+
 #####################
 # Telegram wrappers #
 #####################
-def send(reply_text, reply_markup=None, reply=True):
+class UpdateContext(object):
+    """Data of the telegram update being handled.
+
+    It's passed through handlers instead of using global variables, so
+    several updates can be handled at the same time.
+    """
+
+    def __init__(self, update, message, chat, user, outbox):
+        self.update = update
+        self.message = message
+        self.chat = chat
+        # user who sent the message or clicked the inline button
+        self.user = user
+        self.outbox = outbox
+
+
+class Outbox(object):
+    """Telegram requests of an update.
+
+    Requests are sent in background as soon as they are added, so handler
+    doesn't wait for telegram. Requests to different chats are sent in
+    parallel, while requests to the same chat are sent one by one in the
+    order they are added. Call flush() to wait for all requests.
+
+    A request added via add_inline() is kept until another request to the
+    same chat is added. If it's still kept on flush, it can be returned as
+    response to telegram webhook. That saves a round trip to telegram.
+    """
+
+    def __init__(self, before_send=None):
+        # function to call before a request is sent, e.g. to save pending writes
+        self.before_send = before_send
+        self.lock = threading.Lock()
+        # chat_id -> list of requests that are not sent yet
+        self.queues = {}
+        # chats with failed requests
+        self.failed = set()
+        self.futures = []
+        # (chat_id, payload, func, args, kwargs)
+        self.inline = None
+
+    def add(self, chat_id, func, *args, **kwargs):
+        if self.inline and self.inline[0] == chat_id:
+            self._release_inline()
+        self._add(chat_id, func, args, kwargs)
+
+    def add_inline(self, chat_id, payload, func, *args, **kwargs):
+        """Add request, that can be sent as webhook response.
+
+        Payload is the Bot API method with parameters, e.g.
+        {"method": "sendMessage", "chat_id": 123, "text": "Hello"}
+        """
+        self._release_inline()
+        self.inline = (chat_id, payload, func, args, kwargs)
+
+    def _release_inline(self):
+        if self.inline:
+            chat_id, payload, func, args, kwargs = self.inline
+            self.inline = None
+            self._add(chat_id, func, args, kwargs)
+
+    def _add(self, chat_id, func, args, kwargs):
+        if self.before_send:
+            self.before_send()
+        with self.lock:
+            if chat_id in self.failed:
+                # Don't send next messages to keep the order
+                return
+            queue = self.queues.get(chat_id)
+            if queue is not None:
+                # chat has a running worker
+                queue.append((func, args, kwargs))
+                return
+            self.queues[chat_id] = [(func, args, kwargs)]
+        self.futures.append(send_executor.submit(self._send_queue, chat_id))
+
+    def _send_queue(self, chat_id):
+        while True:
+            with self.lock:
+                queue = self.queues[chat_id]
+                if not queue:
+                    del self.queues[chat_id]
+                    return
+                func, args, kwargs = queue.pop(0)
+            try:
+                func(*args, **kwargs)
+            except:
+                with self.lock:
+                    del self.queues[chat_id]
+                    self.failed.add(chat_id)
+                raise
+
+    def flush(self, webhook=False):
+        """Wait for all requests. Raises the first error, if any.
+
+        If webhook is True, returns payload of the kept request instead of
+        sending it. Returns None otherwise.
+        """
+        payload = None
+        if webhook and self.inline:
+            chat_id, payload = self.inline[:2]
+            self.inline = None
+        self._release_inline()
+        futures = self.futures
+        self.futures = []
+        for future in futures:
+            future.result()
+        if payload and chat_id in self.failed:
+            # previous message is not sent
+            return None
+        return payload
+
+    def discard(self):
+        """Drop requests that are not sent yet and wait for the rest"""
+        self.inline = None
+        with self.lock:
+            for queue in self.queues.values():
+                del queue[:]
+        futures = self.futures
+        self.futures = []
+        for future in futures:
+            future.result()
+
+
+def send(ctx, reply_text, reply_markup=None, reply=True):
     logger.debug('Send message: %s', reply_text)
+    reply_to_message_id = ctx.message['message_id'] if reply else None
+    # https://core.telegram.org/bots/api#sendmessage
+    payload = {
+        'method': 'sendMessage',
+        'chat_id': ctx.chat['id'],
+        'text': str(reply_text),
+        'parse_mode': 'HTML',
+    }
+    if reply_to_message_id:
+        payload['reply_to_message_id'] = reply_to_message_id
+        # the same as "reply message not found" handling in send_message
+        payload['allow_sending_without_reply'] = True
+    if reply_markup:
+        payload['reply_markup'] = json.loads(reply_markup.to_json())
+    ctx.outbox.add_inline(ctx.chat['id'], payload, send_message, ctx.chat['id'], reply_text, reply_markup, reply_to_message_id)
+
+
+def send_message(chat_id, reply_text, reply_markup=None, reply_to_message_id=None):
+    """Send message right now"""
     try:
-        bot.send_message(chat['id'], reply_text, reply_to_message_id=reply and message['message_id'], parse_mode='HTML', reply_markup=reply_markup)
+        bot.send_message(chat_id, reply_text, reply_to_message_id=reply_to_message_id, parse_mode='HTML', reply_markup=reply_markup)
     except ApiException as e:
         res = e.result.json()
-        if reply and res['description'] == "Bad Request: reply message not found":
-            return send(reply_text, reply_markup=reply_markup, reply=False)
+        if reply_to_message_id and res['description'] == "Bad Request: reply message not found":
+            return send_message(chat_id, reply_text, reply_markup=reply_markup)
+
+
+def forward_messages(ctx, messages):
+    """Forward list of (chat_id, message_id) to current chat"""
+    ctx.outbox.add(ctx.chat['id'], forward_messages_now, ctx.chat['id'], messages, ctx.message['message_id'])
+
+
+def forward_messages_now(chat_id, messages, reply_to_message_id=None):
+    """Forward list of (chat_id, message_id) to the chat.
+
+    Messages are sent in batches via forwardMessages method. Each batch
+    contains messages from the same chat in increasing order. Batch is
+    forwarded message by message if the batch method fails.
+    """
+    batches = []
+    for from_chat_id, msg_id in messages:
+        from_chat_id = int(from_chat_id)
+        msg_id = int(msg_id)
+        if batches:
+            batch_chat_id, batch_msg_ids = batches[-1]
+            if batch_chat_id == from_chat_id and batch_msg_ids[-1] < msg_id and len(batch_msg_ids) < FORWARD_BATCH_SIZE:
+                batch_msg_ids.append(msg_id)
+                continue
+        batches.append((from_chat_id, [msg_id]))
+
+    for from_chat_id, msg_ids in batches:
+        if len(msg_ids) > 1:
+            try:
+                # https://core.telegram.org/bots/api#forwardmessages
+                res = telebot.apihelper._make_request(BOT_TOKEN, 'forwardMessages', params={
+                    'chat_id': chat_id,
+                    'from_chat_id': from_chat_id,
+                    'message_ids': json.dumps(msg_ids),
+                }, method='post')
+            except ApiException as e:
+                logger.debug('forwardMessages failed: %s', e)
+            else:
+                # Messages that can't be found are skipped by telegram
+                not_found = len(msg_ids) - len(res)
+                if not_found:
+                    send_message(chat_id, "%s of %s messages are not found. The sender has probably deleted bot's chat history: msg_id=%s..%s" % (
+                        not_found, len(msg_ids), msg_ids[0], msg_ids[-1]), reply_to_message_id=reply_to_message_id)
+                continue
+
+        for msg_id in msg_ids:
+            try:
+                bot.forward_message(
+                    chat_id,
+                    from_chat_id=from_chat_id,
+                    message_id=msg_id,
+                )
+            except ApiException as e:
+                res = e.result.json()
+                if res['description'] == "Bad Request: message to forward not found":
+                    send_message(chat_id, "Message is not found. The sender has probably deleted bot's chat history: msg_id=%s" % msg_id,
+                                 reply_to_message_id=reply_to_message_id)
 
-def notify_another_user(task, reply_text):
+
+def notify_another_user(ctx, task, reply_text):
     another_user_id = None
-    if user['id'] != task.from_id:
+    if ctx.user['id'] != task.from_id:
         another_user_id = task.from_id
-    elif user['id'] != task.to_id:
+    elif ctx.user['id'] != task.to_id:
         another_user_id = task.to_id
 
     if not another_user_id:
@@ -693,7 +1327,9 @@ def notify_another_user(task, reply_text):
     buttons.add(button_tasks_from_me())
     buttons.add(button_my_tasks())
 
-    bot.send_message(
+    ctx.outbox.add(
+        another_user_activity.chat_id,
+        bot.send_message,
         another_user_activity.chat_id,
         reply_text,
         parse_mode='HTML',
@@ -701,6 +1337,32 @@ def notify_another_user(task, reply_text):
     )
 
 
+def webhook_response(payload=None):
+    """Response to telegram webhook.
+
+    Payload is a Bot API method to be called by telegram, see
+    https://core.telegram.org/bots/api#making-requests-when-getting-updates
+    """
+    if not payload:
+        return RESPONSE_200
+    return {
+        "statusCode": 200,
+        "headers": {"Content-Type": "application/json"},
+        "body": json.dumps(payload),
+    }
+
+
+def update2user_id(update):
+    """User who sent the message or clicked the inline button"""
+    data = update.get('message') or update.get('callback_query') or {}
+    return data.get('from', {}).get('id')
+
+
+def update2media_group_id(update):
+    """Album of the message, if any"""
+    return (update.get('message') or {}).get('media_group_id')
+
+
 def escape_html(text):
     return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
 
@@ -750,7 +1412,7 @@ def user_id2name(user_id):
     return USERS.get(str(user_id)) or 'User%s' % user_id
 
 
-def message2description(message):
+def message2description(message, user):
     description = None
     if message.get('text'):
         description = message.get('text')
@@ -767,6 +1429,22 @@ def message2description(message):
     return description
 
 
+def search_tokens(text):
+    """Unique lowercase words of the text, except html tags"""
+    text = re.sub('<[^>]+>', ' ', text or '')
+    res = []
+    for word in re.findall(r'\w+', text.lower()):
+        if len(word) > 1 and word not in res:
+            res.append(word)
+    return res
+
+
+def shorten(text, length):
+    if len(text) <= length:
+        return text
+    return text[:length - 1] + u'\u2026'
+
+
 def task_summary(task, user_id, html=True):
     def wrap(text):
         if not html:
@@ -828,20 +1506,20 @@ def pretty_date(time=False):
         if second_diff < 120:
             return "a minute ago"
         if second_diff < 3600:
-            return str(second_diff / 60) + " minutes ago"
+            return str(second_diff // 60) + " minutes ago"
         if second_diff < 7200:
             return "an hour ago"
         if second_diff < 86400:
-            return str(second_diff / 3600) + " hours ago"
+            return str(second_diff // 3600) + " hours ago"
     if day_diff == 1:
         return "Yesterday"
     if day_diff < 7:
         return str(day_diff) + " days ago"
     if day_diff < 31:
-        return str(day_diff / 7) + " weeks ago"
+        return str(day_diff // 7) + " weeks ago"
     if day_diff < 365:
-        return str(day_diff / 30) + " months ago"
-    return str(day_diff / 365) + " years ago"
+        return str(day_diff // 30) + " months ago"
+    return str(day_diff // 365) + " years ago"
 
 
 #############
@@ -896,33 +1574,734 @@ def decode_callback(data):
 
     return result
 
+####################
+# Storage backends #
+####################
+# Items are dicts in DynamoDB format, e.g. {"id": {"N": "123"}, "description": {"S": "text"}}
+
+
+class ItemNotFound(Exception):
+    pass
+
+
+class ConditionFailed(Exception):
+    """Item doesn't have expected values"""
+    pass
+
+
+class ActivityConflict(ConditionFailed):
+    """User record is changed by another process"""
+    pass
+
+
+class TooManyWrites(Exception):
+    """Unit of work has more items than a transaction can write"""
+    pass
+
+
+FILTER_NE = 'ne'  # attribute is not equal to the value
+FILTER_BEFORE = 'before'  # attribute is absent or less than the value
+
+
+class Storage(object):
+    """Interface of storage engines"""
+
+    def get_item(self, table, key_name, key):
+        """Returns item or None"""
+        raise NotImplementedError()
+
+    def get_items(self, table, key_name, keys):
+        """Returns list of found items in any order"""
+        items = [self.get_item(table, key_name, key) for key in keys]
+        return [item for item in items if item]
+
+    def put_item(self, table, key_name, item):
+        raise NotImplementedError()
+
+    def update_item(self, table, key_name, key, put=None, add=None, expected=None):
+        """Update attributes of an item. Item is created if it doesn't exist.
+
+        * put -- {ATTR: VALUE} to set. Value None removes the attribute
+        * add -- {ATTR: VALUE} to add to a number or to a string set
+        * expected -- {ATTR: VALUE} to check before writing. Value None
+          means that attribute must be absent. Raises ConditionFailed if
+          check fails
+        """
+        raise NotImplementedError()
+
+    def delete_item(self, table, key_name, key):
+        raise NotImplementedError()
+
+    def transact_write(self, writes):
+        """Write many items at once. Nothing is written if any write fails.
+
+        Each write is a dict with keys:
+
+        * table, key_name, key -- the item
+        * item -- the whole item to put. Other keys below are ignored if it's set
+        * put, add, expected -- see update_item
+
+        Raises ConditionFailed if any of expected values doesn't match.
+        """
+        raise NotImplementedError()
+
+    def batch_put(self, table, key_name, items):
+        """Put many items. Unlike transact_write, it's not atomic"""
+        for item in items:
+            self.put_item(table, key_name, item)
+
+    def scan(self, table, key_name, segment=0, total_segments=1, page_size=None, start_key=None):
+        """Read a page of all items of a table.
+
+        Table is split into total_segments parts, that can be read in
+        parallel. Returns (items, last_key) like query.
+        """
+        raise NotImplementedError()
+
+    def query(self, table, key_name, index, conditions, filters=None, page_size=None, start_key=None, before=None):
+        """Read a page of items from a secondary index.
+
+        * conditions -- {ATTR: VALUE} for index keys
+        * before -- (ATTR, VALUE) for sort key, which must be less than the
+          value. Items without the attribute are not in the index
+        * filters -- list of (ATTR, FILTER_*, VALUE)
+
+        Returns (items, last_key). last_key is None for the last page.
+        """
+        raise NotImplementedError()
+
+
+class DynamodbStorage(Storage):
+
+    def __init__(self, client):
+        self.client = client
+
+    def get_item(self, table, key_name, key):
+        res = self.client.get_item(
+            TableName=table,
+            Key={key_name: key},
+        )
+        return res.get('Item')
+
+    def get_items(self, table, key_name, keys):
+        # Doc: https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_BatchGetItem.html
+        # duplicated keys are not allowed
+        keys = list(dict((json.dumps(key, sort_keys=True), key) for key in keys).values())
+        items = []
+        for i in range(0, len(keys), READ_BATCH_SIZE):
+            request = {table: {'Keys': [{key_name: key} for key in keys[i:i + READ_BATCH_SIZE]]}}
+            while request:
+                res = self.client.batch_get_item(RequestItems=request)
+                items += res['Responses'].get(table, [])
+                request = res.get('UnprocessedKeys')
+        return items
+
+    def put_item(self, table, key_name, item):
+        return self.client.put_item(
+            TableName=table,
+            Item=item,
+        )
+
+    @staticmethod
+    def _expressions(put=None, add=None, expected=None):
+        """Request parameters for update and condition expressions"""
+        names = {}
+        values = {}
+        actions = []
+        conditions = []
+        remove = [f for f, value in (put or {}).items() if value is None]
+        put = dict((f, value) for f, value in (put or {}).items() if value is not None)
+        for action, attrs in [('SET', put), ('ADD', add)]:
+            if not attrs:
+                continue
+            expressions = []
+            for f, value in attrs.items():
+                names['#%s' % f] = f
+                values[':%s' % f] = value
+                if action == 'SET':
+                    expressions.append('#%s = :%s' % (f, f))
+                else:
+                    expressions.append('#%s :%s' % (f, f))
+            actions.append('%s %s' % (action, ', '.join(expressions)))
+        if remove:
+            for f in remove:
+                names['#%s' % f] = f
+            actions.append('REMOVE %s' % ', '.join('#%s' % f for f in remove))
+        for f, value in (expected or {}).items():
+            names['#%s' % f] = f
+            if value is None:
+                conditions.append('attribute_not_exists(#%s)' % f)
+            else:
+                values[':expected_%s' % f] = value
+                conditions.append('#%s = :expected_%s' % (f, f))
+
+        kwargs = {}
+        if actions:
+            kwargs['UpdateExpression'] = ' '.join(actions)
+        if conditions:
+            kwargs['ConditionExpression'] = ' AND '.join(conditions)
+        if names:
+            kwargs['ExpressionAttributeNames'] = names
+        if values:
+            kwargs['ExpressionAttributeValues'] = values
+        return kwargs
+
+    def update_item(self, table, key_name, key, put=None, add=None, expected=None):
+        kwargs = self._expressions(put, add, expected)
+        try:
+            return self.client.update_item(
+                TableName=table,
+                Key={key_name: key},
+                **kwargs
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            raise ConditionFailed("Item %s in %s doesn't have expected values" % (key, table))
+
+    def delete_item(self, table, key_name, key):
+        return self.client.delete_item(
+            TableName=table,
+            Key={key_name: key},
+        )
+
+    def transact_write(self, writes):
+        # Doc: https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_TransactWriteItems.html
+        transact_items = []
+        for w in writes:
+            if w.get('item'):
+                request = dict(TableName=w['table'], Item=w['item'])
+                request.update(self._expressions(expected=w.get('expected')))
+                transact_items.append({'Put': request})
+            else:
+                request = dict(TableName=w['table'], Key={w['key_name']: w['key']})
+                request.update(self._expressions(w.get('put'), w.get('add'), w.get('expected')))
+                transact_items.append({'Update': request})
+        try:
+            self.client.transact_write_items(TransactItems=transact_items)
+        except self.client.exceptions.TransactionCanceledException as e:
+            reasons = e.response.get('CancellationReasons', [])
+            if any(r.get('Code') == 'ConditionalCheckFailed' for r in reasons):
+                raise ConditionFailed("Items don't have expected values: %s" % reasons)
+            raise
+
+    def batch_put(self, table, key_name, items):
+        # Doc: https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_BatchWriteItem.html
+        for i in range(0, len(items), WRITE_BATCH_SIZE):
+            request = {table: [{'PutRequest': {'Item': item}} for item in items[i:i + WRITE_BATCH_SIZE]]}
+            attempt = 0
+            while True:
+                res = self.client.batch_write_item(RequestItems=request)
+                request = res.get('UnprocessedItems')
+                if not request:
+                    break
+                # table is throttled, back off
+                time.sleep(min(BATCH_RETRY_DELAY * 2 ** attempt, BATCH_RETRY_MAX_DELAY))
+                attempt += 1
+
+    def scan(self, table, key_name, segment=0, total_segments=1, page_size=None, start_key=None):
+        # Doc: https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Scan.html#Scan.ParallelScan
+        scan_kwargs = dict(
+            TableName=table,
+            Segment=segment,
+            TotalSegments=total_segments,
+        )
+        if page_size:
+            scan_kwargs['Limit'] = page_size
+        if start_key:
+            scan_kwargs['ExclusiveStartKey'] = start_key
+        result = self.client.scan(**scan_kwargs)
+        return result['Items'], result.get('LastEvaluatedKey')
+
+    def query(self, table, key_name, index, conditions, filters=None, page_size=None, start_key=None, before=None):
+        # Doc: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.query
+        names = {}
+        values = {}
+        key_conditions = []
+        for f, value in conditions.items():
+            names['#%s' % f] = f
+            values[':%s' % f] = value
+            key_conditions.append('#%s = :%s' % (f, f))
+        if before:
+            f, value = before
+            names['#%s' % f] = f
+            values[':%s' % f] = value
+            key_conditions.append('#%s < :%s' % (f, f))
+        query_kwargs = dict(
+            TableName=table,
+            IndexName=index,
+            Select='ALL_PROJECTED_ATTRIBUTES',
+            KeyConditionExpression=' and '.join(key_conditions),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+        )
+        filter_expressions = []
+        for f, op, value in filters or []:
+            names['#%s' % f] = f
+            values[':filter_%s' % f] = value
+            if op == FILTER_NE:
+                filter_expressions.append('#%s <> :filter_%s' % (f, f))
+            elif op == FILTER_BEFORE:
+                filter_expressions.append('(attribute_not_exists(#%s) or #%s < :filter_%s)' % (f, f, f))
+        if filter_expressions:
+            query_kwargs['FilterExpression'] = ' and '.join(filter_expressions)
+        if page_size:
+            query_kwargs['Limit'] = page_size
+        if start_key:
+            query_kwargs['ExclusiveStartKey'] = start_key
+
+        result = self.client.query(**query_kwargs)
+        return result['Items'], result.get('LastEvaluatedKey')
+
+
+def value2python(value):
+    """Convert DynamoDB value to python one"""
+    if 'N' in value:
+        return int(value['N']) if value['N'].lstrip('-').isdigit() else float(value['N'])
+    if 'SS' in value:
+        return set(value['SS'])
+    return value.get('S')
+
+
+def check_expected(item, expected):
+    for f, value in (expected or {}).items():
+        if value is None and f in item or value is not None and item.get(f) != value:
+            return False
+    return True
+
+
+def apply_update(item, put=None, add=None):
+    for f, value in (put or {}).items():
+        if value is None:
+            item.pop(f, None)
+        else:
+            item[f] = value
+    for f, value in (add or {}).items():
+        if 'SS' in value:
+            item[f] = {'SS': sorted(set(item.get(f, {'SS': []})['SS']) | set(value['SS']))}
+        else:
+            item[f] = {'N': str(value2python(item.get(f, {'N': '0'})) + value2python(value))}
+    return item
+
+
+def filter_items(items, filters):
+    def match(item):
+        for f, op, value in filters or []:
+            if op == FILTER_NE and item.get(f) == value:
+                return False
+            if op == FILTER_BEFORE and f in item and not value2python(item[f]) < value2python(value):
+                return False
+        return True
+    return [item for item in items if match(item)]
+
+
+class MemoryStorage(Storage):
+    """Keeps items in memory of the current process. It's used for benchmarks and tests"""
+
+    def __init__(self):
+        # table -> {key -> item}
+        self.tables = {}
+        self.lock = threading.RLock()
+
+    def _table(self, table):
+        return self.tables.setdefault(table, {})
+
+    def get_item(self, table, key_name, key):
+        with self.lock:
+            item = self._table(table).get(value2python(key))
+            return copy.deepcopy(item)
+
+    def put_item(self, table, key_name, item):
+        with self.lock:
+            self._table(table)[value2python(item[key_name])] = copy.deepcopy(item)
+
+    def update_item(self, table, key_name, key, put=None, add=None, expected=None):
+        with self.lock:
+            item = self._table(table).get(value2python(key)) or {key_name: key}
+            if not check_expected(item, expected):
+                raise ConditionFailed("Item %s in %s doesn't have expected values" % (key, table))
+            self._table(table)[value2python(key)] = apply_update(copy.deepcopy(item), put, add)
+
+    def delete_item(self, table, key_name, key):
+        with self.lock:
+            self._table(table).pop(value2python(key), None)
+
+    def transact_write(self, writes):
+        with self.lock:
+            for w in writes:
+                item = self._table(w['table']).get(value2python(w['key'])) or {}
+                if not check_expected(item, w.get('expected')):
+                    raise ConditionFailed("Item %s in %s doesn't have expected values" % (w['key'], w['table']))
+            for w in writes:
+                if w.get('item'):
+                    self.put_item(w['table'], w['key_name'], w['item'])
+                else:
+                    self.update_item(w['table'], w['key_name'], w['key'], put=w.get('put'), add=w.get('add'))
+
+    def query(self, table, key_name, index, conditions, filters=None, page_size=None, start_key=None, before=None):
+        with self.lock:
+            items = [
+                item for key, item in sorted(self._table(table).items())
+                if all(item.get(f) == value for f, value in conditions.items())
+                and (not before or before[0] in item and value2python(item[before[0]]) < value2python(before[1]))
+            ]
+        if start_key:
+            start = value2python(start_key[key_name])
+            items = [item for item in items if value2python(item[key_name]) > start]
+        last_key = None
+        if page_size and len(items) > page_size:
+            items = items[:page_size]
+            last_key = dict((k, items[-1][k]) for k in [key_name] + INDEX_KEYS[index])
+        return copy.deepcopy(filter_items(items, filters)), last_key
+
+    def scan(self, table, key_name, segment=0, total_segments=1, page_size=None, start_key=None):
+        with self.lock:
+            items = [
+                item for key, item in sorted(self._table(table).items())
+                if key % total_segments == segment
+                and (not start_key or key > value2python(start_key[key_name]))
+            ]
+        last_key = None
+        if page_size and len(items) > page_size:
+            items = items[:page_size]
+            last_key = {key_name: items[-1][key_name]}
+        return copy.deepcopy(items), last_key
+
+
+class SqliteStorage(Storage):
+    """Keeps items in a SQLite database.
+
+    Each table has columns for keys of secondary indexes and SQLite indexes
+    mirroring them, so queries don't scan the table.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.RLock()
+        self.tables = set()
+        self.columns = sorted(set(sum(INDEX_KEYS.values(), [])))
+
+    def _table(self, table):
+        if table not in self.tables:
+            self.db.execute('CREATE TABLE IF NOT EXISTS "%s" (pk INTEGER PRIMARY KEY, item TEXT NOT NULL, %s)' % (
+                table, ', '.join('%s INTEGER' % c for c in self.columns)))
+            for index, keys in INDEX_KEYS.items():
+                self.db.execute('CREATE INDEX IF NOT EXISTS "%s:%s" ON "%s" (%s, pk)' % (
+                    table, index, table, ', '.join(keys)))
+            self.tables.add(table)
+        return table
+
+    def _get(self, table, key):
+        row = self.db.execute('SELECT item FROM "%s" WHERE pk = ?' % self._table(table), (value2python(key),)).fetchone()
+        return row and json.loads(row[0])
+
+    def _put(self, table, key_name, item):
+        self.db.execute('INSERT OR REPLACE INTO "%s" (pk, item, %s) VALUES (?, ?, %s)' % (
+            self._table(table), ', '.join(self.columns), ', '.join('?' for c in self.columns)), [
+            value2python(item[key_name]),
+            json.dumps(item),
+        ] + [value2python(item[c]) if c in item else None for c in self.columns])
+
+    def get_item(self, table, key_name, key):
+        with self.lock:
+            return self._get(table, key)
+
+    def put_item(self, table, key_name, item):
+        with self.lock:
+            self._put(table, key_name, item)
+
+    def update_item(self, table, key_name, key, put=None, add=None, expected=None):
+        with self.lock:
+            # lock the database for other processes until the item is written
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                item = self._get(table, key) or {key_name: key}
+                if not check_expected(item, expected):
+                    raise ConditionFailed("Item %s in %s doesn't have expected values" % (key, table))
+                self._put(table, key_name, apply_update(item, put, add))
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+
+    def delete_item(self, table, key_name, key):
+        with self.lock:
+            self.db.execute('DELETE FROM "%s" WHERE pk = ?' % self._table(table), (value2python(key),))
+
+    def transact_write(self, writes):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                for w in writes:
+                    item = self._get(w['table'], w['key']) or {w['key_name']: w['key']}
+                    if not check_expected(item, w.get('expected')):
+                        raise ConditionFailed("Item %s in %s doesn't have expected values" % (w['key'], w['table']))
+                    if w.get('item'):
+                        item = w['item']
+                    else:
+                        item = apply_update(item, w.get('put'), w.get('add'))
+                    self._put(w['table'], w['key_name'], item)
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+
+    def query(self, table, key_name, index, conditions, filters=None, page_size=None, start_key=None, before=None):
+        where = ['%s = ?' % f for f in conditions]
+        args = [value2python(value) for value in conditions.values()]
+        if before:
+            where.append('%s < ?' % before[0])
+            args.append(value2python(before[1]))
+        if start_key:
+            where.append('pk > ?')
+            args.append(value2python(start_key[key_name]))
+        args.append(page_size or -1)
+        with self.lock:
+            rows = self.db.execute('SELECT item FROM "%s" INDEXED BY "%s:%s" WHERE %s ORDER BY pk LIMIT ?' % (
+                self._table(table), table, index, ' AND '.join(where)), args).fetchall()
+        items = [json.loads(row[0]) for row in rows]
+        last_key = None
+        if page_size and len(items) == page_size:
+            last_key = dict((k, items[-1][k]) for k in [key_name] + INDEX_KEYS[index])
+        return filter_items(items, filters), last_key
+
+    def batch_put(self, table, key_name, items):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                for item in items:
+                    self._put(table, key_name, item)
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+
+    def scan(self, table, key_name, segment=0, total_segments=1, page_size=None, start_key=None):
+        start = value2python(start_key[key_name]) if start_key else None
+        with self.lock:
+            rows = self.db.execute('SELECT item FROM "%s" WHERE pk %% ? = ? AND (? IS NULL OR pk > ?) ORDER BY pk LIMIT ?' % (
+                self._table(table)), (total_segments, segment, start, start, page_size or -1)).fetchall()
+        items = [json.loads(row[0]) for row in rows]
+        last_key = None
+        if page_size and len(items) == page_size:
+            last_key = {key_name: items[-1][key_name]}
+        return items, last_key
+
+
+def make_storage(url):
+    if url == 'memory':
+        return MemoryStorage()
+    if url.startswith('sqlite:'):
+        return SqliteStorage(url[len('sqlite:'):])
+    return DynamodbStorage(boto3.client('dynamodb'))
+
+
+storage = make_storage(STORAGE)
+
+
 #####################
 # DynamoDB wrappers #
 #####################
 
 
+class UnitOfWork(object):
+    """Pending writes of an update.
+
+    While a unit of work is active in the current thread, writes of
+    DynamodbItem are kept in memory instead of sending them to the storage.
+    Changes of the same item are merged into a single write. commit() sends
+    them as a single request: update of one item or transaction over many
+    items, so either all changes are saved or none.
+
+    Pending writes are committed before reading them back, i.e. before
+    querying a table with changed items.
+
+    A transaction writes at most TRANSACT_MAX_ITEMS items. An update changes
+    a few items only, so commit() raises TooManyWrites above the limit
+    rather than splitting the writes and losing atomicity.
+
+    Items loaded by id or written are kept in identity map, so an item is
+    read from the storage at most once and the same object is returned on
+    next loads.
+    """
+
+    _local = threading.local()
+
+    def __init__(self):
+        # (table, key) -> write, see Storage.transact_write
+        self.writes = {}
+        # functions to call once the writes are saved
+        self.after_commit = []
+        # (table, key) -> DynamodbItem
+        self.identity_map = {}
+
+    def __enter__(self):
+        self._local.current = self
+        return self
+
+    def __exit__(self, *args):
+        self._local.current = None
+
+    @classmethod
+    def current(cls):
+        return getattr(cls._local, 'current', None)
+
+    @classmethod
+    def autoflush(cls, table, key=None):
+        """Commit current unit of work if it has writes to the table (and item)"""
+        uow = cls.current()
+        if uow and uow.is_pending(table, key):
+            uow.commit()
+
+    @staticmethod
+    def _id(table, key):
+        return (table, json.dumps(key, sort_keys=True))
+
+    def is_pending(self, table, key=None):
+        if key is not None:
+            return self._id(table, key) in self.writes
+        return any(t == table for t, k in self.writes)
+
+    def get_loaded(self, table, key):
+        return self.identity_map.get(self._id(table, key))
+
+    def set_loaded(self, table, key, obj):
+        self.identity_map[self._id(table, key)] = obj
+
+    def add(self, table, key_name, key, item=None, put=None, add=None, expected=None, after_commit=None):
+        """Add a write. See Storage.transact_write for the arguments.
+
+        Expected values are checked against the item as it was before the
+        first write of the unit of work.
+        """
+        w = self.writes.get(self._id(table, key))
+        if not w:
+            w = self.writes[self._id(table, key)] = {
+                'table': table,
+                'key_name': key_name,
+                'key': key,
+                'item': None,
+                'put': {},
+                'add': {},
+                'expected': expected,
+            }
+        if item:
+            w['item'] = copy.deepcopy(item)
+            w['put'] = {}
+            w['add'] = {}
+        elif w['item']:
+            apply_update(w['item'], put, add)
+        else:
+            for f, value in (put or {}).items():
+                w['put'][f] = value
+                w['add'].pop(f, None)
+            for f, value in (add or {}).items():
+                pending = w['put'] if f in w['put'] else w['add']
+                if f in pending:
+                    apply_update(pending, add={f: value})
+                else:
+                    pending[f] = value
+        if after_commit:
+            self.after_commit.append(after_commit)
+
+    def commit(self):
+        writes = list(self.writes.values())
+        callbacks = self.after_commit
+        self.writes = {}
+        self.after_commit = []
+        if len(writes) > TRANSACT_MAX_ITEMS:
+            # DynamoDB would reject the request with ValidationException
+            raise TooManyWrites("%s items are changed, but a transaction can write at most %s" % (len(writes), TRANSACT_MAX_ITEMS))
+        if len(writes) == 1 and not writes[0]['expected'] and writes[0]['item']:
+            w = writes[0]
+            storage.put_item(w['table'], w['key_name'], w['item'])
+        elif len(writes) == 1 and not writes[0]['item']:
+            w = writes[0]
+            storage.update_item(w['table'], w['key_name'], w['key'], put=w['put'], add=w['add'], expected=w['expected'])
+        elif writes:
+            storage.transact_write(writes)
+        for func in callbacks:
+            func()
+
+
+class QueryResult(object):
+    """Lazy iterator over query results.
+
+    Pages are requested on demand by following last evaluated key.
+    ``last_key`` is a cursor to resume iteration via ``start_key``. It's
+    None once all results are read.
+    """
+
+    def __init__(self, item_class, index, conditions, filters=None, limit=None, page_size=None, start_key=None, before=None):
+        self.item_class = item_class
+        self.index = index
+        self.conditions = conditions
+        self.before = before
+        self.filters = filters
+        self.limit = limit
+        self.page_size = page_size
+        self.last_key = start_key
+        # attributes that make up start key for the index
+        self.key_attrs = [item_class.PARTITION_KEY] + INDEX_KEYS[index]
+
+    def __iter__(self):
+        UnitOfWork.autoflush(self.item_class.TABLE)
+        count = 0
+        while True:
+            items, last_key = storage.query(
+                self.item_class.TABLE,
+                self.item_class.PARTITION_KEY,
+                self.index,
+                self.conditions,
+                filters=self.filters,
+                page_size=self.page_size,
+                start_key=self.last_key,
+                before=self.before,
+            )
+            for d in items:
+                self.last_key = dict((k, d[k]) for k in self.key_attrs)
+                yield self.item_class.load_from_dict(d)
+                count += 1
+                if self.limit and count >= self.limit:
+                    return
+            self.last_key = last_key
+            if not self.last_key:
+                return
+
+
 class DynamodbItem(object):
     STR_PARAMS = []
     INT_PARAMS = []
     TABLE = 'to-be-updated'
     PARTITION_KEY = 'id'
+    # write via current UnitOfWork, if any
+    UNIT_OF_WORK = True
 
     # Reading
     @classmethod
     def load_by_id(cls, id, raise_if_not_found=False):
-        res = dynamodb.get_item(
-            TableName=cls.TABLE,
-            Key={
-                cls.PARTITION_KEY: cls.elem_to_num(id),
-            }
-        )
-        if not res.get('Item'):
+        key = cls.elem_to_num(id)
+        uow = cls.UNIT_OF_WORK and UnitOfWork.current()
+        if uow:
+            obj = uow.get_loaded(cls.TABLE, key)
+            if obj:
+                return obj
+            UnitOfWork.autoflush(cls.TABLE, key)
+        item = storage.get_item(cls.TABLE, cls.PARTITION_KEY, key)
+        if not item:
             if raise_if_not_found:
-                raise Exception("Attempt for loading unexisting record: %s")
+                raise ItemNotFound("Attempt for loading unexisting record: %s" % id)
             else:
-                # New Item
+                # New Item. It's not kept in identity map until it's written
                 return cls(id)
-        return cls.load_from_dict(res['Item'])
+        obj = cls.load_from_dict(item)
+        if uow:
+            uow.set_loaded(cls.TABLE, key, obj)
+        return obj
+
+    @classmethod
+    def load_by_ids(cls, ids):
+        """Load existing items with a few requests. Order is not kept"""
+        items = storage.get_items(cls.TABLE, cls.PARTITION_KEY, [cls.elem_to_num(id) for id in ids])
+        return [cls.load_from_dict(d) for d in items]
 
     @classmethod
     def load_from_dict(cls, d):
@@ -958,30 +2337,76 @@ class DynamodbItem(object):
 
         return res
 
-    def _update(self, AttributeUpdates):
-        return dynamodb.update_item(
-            TableName=self.TABLE,
-            Key={
-                self.PARTITION_KEY: DynamodbItem.elem_to_num(getattr(self, self.PARTITION_KEY))
-            },
-            AttributeUpdates=AttributeUpdates,
-        )
+    def _key(self):
+        return self.elem_to_num(getattr(self, self.PARTITION_KEY))
+
+    def _unit_of_work(self):
+        return self.UNIT_OF_WORK and UnitOfWork.current()
+
+    def _update(self, put=None, add=None, expected=None):
+        uow = self._unit_of_work()
+        if uow:
+            # next loads get this object with up-to-date values
+            uow.set_loaded(self.TABLE, self._key(), self)
+            return uow.add(self.TABLE, self.PARTITION_KEY, self._key(), put=put, add=add, expected=expected)
+        return storage.update_item(self.TABLE, self.PARTITION_KEY, self._key(), put=put, add=add, expected=expected)
+
+    def _after_write(self, func):
+        """Call func once the last write is saved"""
+        uow = self._unit_of_work()
+        if uow:
+            uow.after_commit.append(func)
+        else:
+            func()
 
     def update(self, *fields):
         d = self.to_dict()
         if not fields:
-            return dynamodb.put_item(
-                TableName=self.TABLE,
-                Item=d,
-            )
+            uow = self._unit_of_work()
+            if uow:
+                uow.set_loaded(self.TABLE, self._key(), self)
+                return uow.add(self.TABLE, self.PARTITION_KEY, self._key(), item=d)
+            return storage.put_item(self.TABLE, self.PARTITION_KEY, d)
         else:
-            AttributeUpdates = {}
-            for f in fields:
-                AttributeUpdates[f] = {
-                    'Value': d.get(f),
-                    'Action': 'PUT',
-                }
-            return self._update(AttributeUpdates)
+            return self._update(put=dict((f, d.get(f)) for f in fields))
+
+    def delete(self):
+        UnitOfWork.autoflush(self.TABLE, self._key())
+        return storage.delete_item(self.TABLE, self.PARTITION_KEY, self._key())
+
+    @classmethod
+    def batch_update(cls, items, fields, expected=None):
+        """Write the fields of many items in parallel. Each item is written by
+        own request, so a failed write doesn't affect the others. It's retried
+        once. The first error is raised once all items are written.
+
+        A single transact_write_items request is not used: it costs twice as
+        much and fails as a whole on any conflict, while the items here are
+        independent.
+
+        expected -- see Storage.update_item. Items that don't match it are
+        skipped
+        """
+        def write(item):
+            d = item.to_dict()
+            put = dict((f, d.get(f)) for f in fields)
+            for attempt in range(2):
+                try:
+                    storage.update_item(cls.TABLE, cls.PARTITION_KEY, item._key(), put=put, expected=expected)
+                except ConditionFailed:
+                    logger.debug('Item %s in %s is changed meanwhile. Skip it', item._key(), cls.TABLE)
+                except Exception:
+                    if attempt:
+                        raise
+                    logger.warning('Error on writing item %s to %s. Retrying', item._key(), cls.TABLE, exc_info=True)
+                    time.sleep(BATCH_RETRY_DELAY)
+                    continue
+                break
+
+        futures = [write_executor.submit(write, item) for item in items]
+        wait(futures)
+        for future in futures:
+            future.result()
 
 
 # DYNAMODB_TABLE_USER
@@ -996,10 +2421,12 @@ class DynamodbItem(object):
 #   "task_id": TASK_ID,
 #   "telegram_unixtime": UNIXTIME, // date-time according to data from telegram
 #   "unixtime": UNIXTIME, // server date-time
+#   "media_group_id": MEDIA_GROUP_ID, // album of the last message attached to the task
+#   "version": VERSION, // incremented on each write
 # }
 class User(DynamodbItem):
-    INT_PARAMS = ['user_id', 'chat_id', 'task_id', 'telegram_unixtime', 'unixtime']
-    STR_PARAMS = ['activity']
+    INT_PARAMS = ['user_id', 'chat_id', 'task_id', 'telegram_unixtime', 'unixtime', 'version']
+    STR_PARAMS = ['activity', 'media_group_id']
     TABLE = DYNAMODB_TABLE_USER
     PARTITION_KEY = 'user_id'
 
@@ -1016,6 +2443,28 @@ class User(DynamodbItem):
         self.task_id = 0
         self.telegram_unixtime = 0
         self.unixtime = 0  # it's not used for now
+        self.version = 0
+        self.media_group_id = ''
+
+    def update(self, *fields):
+        """Write fields if the record is not changed since it's loaded.
+
+        Raises ActivityConflict otherwise. Within UnitOfWork the check is
+        done on commit and ConditionFailed is raised instead.
+        """
+        d = self.to_dict()
+        if not fields:
+            fields = [p for p in self.INT_PARAMS + self.STR_PARAMS if p not in [self.PARTITION_KEY, 'version']]
+        put = dict((f, d[f]) for f in fields)
+        put['version'] = self.elem_to_num(self.version + 1)
+        # Version 0 is for new record or record created before versioning
+        expected = {'version': self.elem_to_num(self.version) if self.version else None}
+        try:
+            res = self._update(put=put, expected=expected)
+        except ConditionFailed:
+            raise ActivityConflict("User %s is changed by another process" % self.user_id)
+        self.version += 1
+        return res
 
     def update_activity(self):
         return self.update('activity')
@@ -1029,6 +2478,13 @@ class User(DynamodbItem):
     def update_time(self):
         return self.update('telegram_unixtime')
 
+    def set_media_group(self, message):
+        """Remember album of the message attached to the task"""
+        media_group_id = message.get('media_group_id', '')
+        if self.media_group_id != media_group_id:
+            self.media_group_id = media_group_id
+            self.update('media_group_id')
+
     # Reading
     @classmethod
     def load_by_id(cls, id, chat=None):
@@ -1044,6 +2500,36 @@ class User(DynamodbItem):
     def update_chat_id(self):
         return self.update('chat_id')
 
+
+# Progress of the last cron run. It's kept in DYNAMODB_TABLE_USER under
+# reserved user_id 0
+#
+# {
+#   // PRIMARY KEY
+#   "user_id": 0,
+#
+#   "unixtime": UNIXTIME, // time of the cron event
+#   "done_users": "USER_ID,USER_ID", // users that already got reminders
+# }
+class CronCheckpoint(DynamodbItem):
+    INT_PARAMS = ['user_id', 'unixtime']
+    STR_PARAMS = ['done_users']
+    TABLE = DYNAMODB_TABLE_USER
+    PARTITION_KEY = 'user_id'
+
+    CHECKPOINT_ID = 0
+
+    def __init__(self, user_id=CHECKPOINT_ID):
+        self.user_id = user_id
+        self.unixtime = 0
+        self.done_users = ''
+
+    def get_done_users(self):
+        return [user_id for user_id in self.done_users.split(',') if user_id]
+
+    def set_done_users(self, user_ids):
+        self.done_users = ','.join(user_ids)
+
 # DYNAMODB_TABLE_TASK
 # Task structure:
 #
@@ -1068,14 +2554,14 @@ class User(DynamodbItem):
 #   // Normal keys
 #   "msg_num": INTEGER,
 #   "next_reminder": UNIXTIME,
-#   "messages": [CHAT_ID + '_' + MESSAGE_ID],
+#   "remind_at": UNIXTIME, // copy of next_reminder for TODO tasks. Key of REMIND_INDEX
+#   "messages": [NUMBER + '_' + CHAT_ID + '_' + MESSAGE_ID], // if DYNAMODB_TABLE_MESSAGES is not set. NUMBER keeps the order
 # }
 
 
 class Task(DynamodbItem):
     STR_PARAMS = ['description']
     INT_PARAMS = ['id', 'from_id', 'to_id', 'task_state', 'telegram_unixtime', 'msg_num', 'next_reminder']
-    CHAT_MSG_PARAMS = ['messages']
     TABLE = DYNAMODB_TABLE_TASK
 
     def __init__(self, id=0, task_state=TASK_STATE_TODO, user_id=0):
@@ -1085,8 +2571,14 @@ class Task(DynamodbItem):
         self.to_id = user_id
         self.telegram_unixtime = 0
         self.msg_num = 0
+        self.next_reminder = 0
         self.description = '*New Task*'
-        self.messages = []
+        # list of (chat_id, message_id). Use messages property to read it
+        self._messages = []
+        # messages of the task item, that are not parsed yet
+        self._raw_messages = None
+        # whether messages of DYNAMODB_TABLE_MESSAGES are read
+        self._chunks_loaded = True
 
     # Preparing
     @staticmethod
@@ -1095,115 +2587,395 @@ class Task(DynamodbItem):
         return (chat['id'], message['message_id'])
 
     def add_message(self, message):
-        self.messages.append(self._message2tuple(message))
+        if self._chunks_loaded:
+            self._messages.append(self._message2tuple(message))
+        # otherwise the message is read along with the other ones
         self.msg_num += 1
 
     # Reading
     @classmethod
     def load_from_dict(cls, d):
         task = super(Task, cls).load_from_dict(d)
-
-        for ss_param in cls.CHAT_MSG_PARAMS:
-            if d.get(ss_param):
-                setattr(task, ss_param, [
-                    chat_msg.split('_')
-                    for chat_msg in d[ss_param]['SS']
-                ])
+        # messages are needed to print the task only, so they are parsed on demand
+        if d.get('messages'):
+            task._raw_messages = d['messages']['SS']
+        task._chunks_loaded = not DYNAMODB_TABLE_MESSAGES
         return task
 
+    @property
+    def messages(self):
+        if self._raw_messages is not None:
+            self._messages = self._load_messages(self._raw_messages) + self._messages
+            self._raw_messages = None
+        if not self._chunks_loaded:
+            self._chunks_loaded = True
+            self._messages += TaskMessages.load_messages(self.id, self.msg_num)
+        return self._messages
+
     @classmethod
-    def get_tasks(cls, to_me=True, user_id=None, task_state=None):
-        # Doc: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.query
-        args = {
-            ':user_id': Task.elem_to_num(user_id)
-        }
-        filter_expression = None
+    def get_tasks(cls, to_me=True, user_id=None, task_state=None, limit=None, page_size=QUERY_PAGE_SIZE, start_key=None):
+        filters = []
         if to_me:
-            condition = "to_id = :user_id"
+            conditions = {'to_id': cls.elem_to_num(user_id)}
             index = TO_INDEX
         else:
-            condition = "from_id = :user_id"
-            filter_expression = "to_id <> :user_id"
+            conditions = {'from_id': cls.elem_to_num(user_id)}
+            filters.append(('to_id', FILTER_NE, cls.elem_to_num(user_id)))
             index = FROM_INDEX
 
-        if task_state is None:
-            pass
-        else:
-            condition += " and task_state = :task_state"
-            args[':task_state'] = Task.elem_to_num(task_state)
-
-        query_kwargs = dict(
-            TableName=cls.TABLE,
-            IndexName=index,
-            Select='ALL_PROJECTED_ATTRIBUTES',
-            KeyConditionExpression=condition,
-            ExpressionAttributeValues=args,
-        )
-        if filter_expression:
-            query_kwargs['FilterExpression'] = filter_expression
-
-        result = dynamodb.query(**query_kwargs)
+        if task_state is not None:
+            conditions['task_state'] = cls.elem_to_num(task_state)
 
-        return (cls.load_from_dict(task_dict) for task_dict in result['Items'])
+        return QueryResult(cls, index, conditions, filters, limit=limit, page_size=page_size, start_key=start_key)
 
     @classmethod
-    def get_tasks_to_remind(cls, user_id, unixtime_now):
-        # Doc: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.query
-        condition = "to_id = :user_id and task_state = :task_state"
-        filter_expression = "attribute_not_exists(next_reminder) or next_reminder < :unixtime_now"
-        args = {
-            ':user_id': Task.elem_to_num(user_id),
-            ':task_state': Task.elem_to_num(TASK_STATE_TODO),
-            ':unixtime_now': Task.elem_to_num(unixtime_now),
+    def get_tasks_to_remind(cls, user_id, unixtime_now, limit=None, page_size=QUERY_PAGE_SIZE, start_key=None):
+        if USE_REMIND_INDEX:
+            # only due tasks are read
+            return QueryResult(
+                cls, REMIND_INDEX, {'to_id': cls.elem_to_num(user_id)},
+                before=('remind_at', cls.elem_to_num(unixtime_now)),
+                limit=limit, page_size=page_size, start_key=start_key)
+        conditions = {
+            'to_id': cls.elem_to_num(user_id),
+            'task_state': cls.elem_to_num(TASK_STATE_TODO),
         }
-        query_kwargs = dict(
-            TableName=cls.TABLE,
-            IndexName=TO_INDEX,
-            Select='ALL_PROJECTED_ATTRIBUTES',
-            KeyConditionExpression=condition,
-            ExpressionAttributeValues=args,
-            FilterExpression=filter_expression
-        )
-
-        result = dynamodb.query(**query_kwargs)
+        filters = [('next_reminder', FILTER_BEFORE, cls.elem_to_num(unixtime_now))]
+        return QueryResult(cls, TO_INDEX, conditions, filters, limit=limit, page_size=page_size, start_key=start_key)
 
-        return (cls.load_from_dict(task_dict) for task_dict in result['Items'])
+    @staticmethod
+    def _load_messages(values):
+        """Parse stored messages. Returns list of (chat_id, message_id) in
+        the order they were attached.
+
+        Members of a string set come in any order, so each value keeps the
+        number of the message in the task. Values saved by older versions
+        of the bot have no number. They go first, in order of message ids
+        in each chat.
+        """
+        def key(parts):
+            if len(parts) == 2:
+                return (0, int(parts[0]), int(parts[1]))
+            return (1, int(parts[0]))
+        return [parts[-2:] for parts in sorted((v.split('_') for v in values), key=key)]
 
     # Writing
     @classmethod
-    def _dump_messages(self, array):
+    def _dump_messages(self, array, start=0):
+        """array is list of (chat_id, message_id) with numbers from start"""
         return self.elem_to_array_of_str(
-            ['%s_%s' % (m[0], m[1]) for m in array]
+            ['%s_%s_%s' % (start + i, m[0], m[1]) for i, m in enumerate(array)]
         )
 
+    def summary_dict(self):
+        """Attributes to print the task in a list, see task_summary"""
+        return super(Task, self).to_dict()
+
     def to_dict(self):
         res = super(Task, self).to_dict()
-        for ss_param in self.CHAT_MSG_PARAMS:
-            res[ss_param] = self._dump_messages(getattr(self, ss_param))
+        if not DYNAMODB_TABLE_MESSAGES:
+            res['messages'] = self._dump_messages(self.messages)
+        if self.task_state == TASK_STATE_TODO:
+            res['remind_at'] = self.elem_to_num(self.next_reminder)
+        return res
+
+    def update(self, *fields):
+        res = super(Task, self).update(*fields)
+        if not fields and DYNAMODB_TABLE_MESSAGES:
+            # messages are not in the task item
+            TaskMessages.add_messages(self.id, 0, self.messages)
+        self._invalidate_cache()
+        if not fields or 'description' in fields or 'to_id' in fields:
+            task_id, user_ids, description = self.id, [self.from_id, self.to_id], self.description
+            self._after_write(lambda: search_index.add(task_id, user_ids, description))
         return res
 
+    def _invalidate_cache(self):
+        from_id, to_id = self.from_id, self.to_id
+        self._after_write(lambda: tasks_cache.invalidate(from_id, to_id))
+
     def update_task_state(self):
-        return self.update('task_state')
+        # task leaves REMIND_INDEX when it's not TODO anymore
+        return self.update('task_state', 'remind_at')
 
     def update_description(self):
         return self.update('description')
 
-    def update_assigned_to(self):
+    def update_assigned_to(self, old_to_id=None):
+        if old_to_id:
+            self._after_write(lambda: tasks_cache.invalidate(old_to_id))
         return self.update('to_id')
 
     def update_next_reminder(self):
-        return self.update('next_reminder')
+        return self.update('next_reminder', 'remind_at')
 
     def add_and_update_messages(self, message):
+        index = self.msg_num
+        # keep the object in line with the stored item
+        self.add_message(message)
         array = [self._message2tuple(message)]
-        AttributeUpdates = {}
-        AttributeUpdates['messages'] = {
-            'Value': self._dump_messages(array),
-            'Action': 'ADD',
-        }
-        AttributeUpdates['msg_num'] = {
-            'Value': self.elem_to_num(1),
-            'Action': 'ADD',
-        }
-        return self._update(AttributeUpdates)
+        if DYNAMODB_TABLE_MESSAGES:
+            TaskMessages.add_messages(self.id, index, array)
+            res = self._update(add={
+                'msg_num': self.elem_to_num(1),
+            })
+        else:
+            res = self._update(add={
+                'messages': self._dump_messages(array, index),
+                'msg_num': self.elem_to_num(1),
+            })
+        # number of attached messages is shown in task lists
+        self._invalidate_cache()
+        return res
+
+
+# DYNAMODB_TABLE_MESSAGES
+# Structure of a chunk of task's messages:
+#
+# {
+#   // PRIMARY KEY
+#   "id": ID, //= TASK_ID * MESSAGES_CHUNKS_MAX + CHUNK_NUMBER
+#
+#   "messages": [NUMBER + '_' + CHAT_ID + '_' + MESSAGE_ID], // messages with numbers from CHUNK_NUMBER * MESSAGES_CHUNK_SIZE
+# }
+class TaskMessages(DynamodbItem):
+    INT_PARAMS = ['id']
+    TABLE = DYNAMODB_TABLE_MESSAGES
+
+    @staticmethod
+    def _chunk_id(task_id, index):
+        chunk = min(index // MESSAGES_CHUNK_SIZE, MESSAGES_CHUNKS_MAX - 1)
+        return task_id * MESSAGES_CHUNKS_MAX + chunk
+
+    @classmethod
+    def add_messages(cls, task_id, index, messages):
+        """Save messages with numbers starting from index"""
+        # chunk_id -> (number of the first message, messages)
+        chunks = {}
+        for i, m in enumerate(messages):
+            chunks.setdefault(cls._chunk_id(task_id, index + i), (index + i, []))[1].append(m)
+        for chunk_id, (start, array) in chunks.items():
+            cls(chunk_id)._update(add={'messages': Task._dump_messages(array, start)})
+
+    @classmethod
+    def load_messages(cls, task_id, msg_num):
+        # Messages may be added by another process after the task is
+        # loaded, so the chunk for the next message is read too
+        ids = range(cls._chunk_id(task_id, 0), cls._chunk_id(task_id, msg_num) + 1)
+        for id in ids:
+            UnitOfWork.autoflush(cls.TABLE, cls.elem_to_num(id))
+        items = storage.get_items(cls.TABLE, cls.PARTITION_KEY, [cls.elem_to_num(id) for id in ids])
+        res = []
+        for d in sorted(items, key=lambda d: int(d['id']['N'])):
+            res += Task._load_messages(d['messages']['SS'])
+        return res
+
+    def __init__(self, id=0):
+        self.id = id
+
+
+# DYNAMODB_TABLE_CACHE
+# Cache structure:
+#
+# {
+#   // PRIMARY KEY
+#   "user_id": USER_ID,
+#
+#   "tasks_to_me": "[TASK_SUMMARY_DICT, ...]", // tasks of /mytasks, see Task.summary_dict
+#   "tasks_to_me_expire": UNIXTIME,
+#   "tasks_from_me": "[TASK_SUMMARY_DICT, ...]", // tasks of /tasks_from_me
+#   "tasks_from_me_expire": UNIXTIME,
+# }
+class TasksCacheItem(DynamodbItem):
+    INT_PARAMS = ['user_id', 'tasks_to_me_expire', 'tasks_from_me_expire']
+    STR_PARAMS = ['tasks_to_me', 'tasks_from_me']
+    TABLE = DYNAMODB_TABLE_CACHE
+    PARTITION_KEY = 'user_id'
+    # cache is written while the task lists are rendered
+    UNIT_OF_WORK = False
+
+    def __init__(self, user_id=0):
+        self.user_id = user_id
+        self.tasks_to_me = ''
+        self.tasks_to_me_expire = 0
+        self.tasks_from_me = ''
+        self.tasks_from_me_expire = 0
+
+
+class TasksCache(object):
+    """Task lists per user.
+
+    Lists are kept in memory of the current process. If shared is True, the
+    lists are kept in the storage instead, so the cache is shared between
+    concurrent Lambda containers and invalidation is seen by all of them.
+    Invalidation of the memory cache reaches the current container only, so
+    it's used only if ttl is set explicitly. ttl 0 disables the cache.
+    """
+
+    def __init__(self, ttl, shared=False):
+        self.ttl = ttl
+        self.shared = shared
+        # (user_id, to_me) -> (expire, tasks)
+        self.lists = {}
+
+    @staticmethod
+    def _field(to_me):
+        return 'tasks_to_me' if to_me else 'tasks_from_me'
+
+    def get(self, user_id, to_me):
+        if not self.ttl:
+            return None
+        # apply pending invalidations
+        UnitOfWork.autoflush(DYNAMODB_TABLE_TASK)
+        now = time.time()
+        if not self.shared:
+            expire, tasks = self.lists.get((user_id, to_me), (0, None))
+            if expire < now:
+                return None
+            return tasks
+
+        field = self._field(to_me)
+        item = TasksCacheItem.load_by_id(user_id)
+        if getattr(item, field + '_expire') < now:
+            return None
+        return json.loads(getattr(item, field))
+
+    def set(self, user_id, to_me, tasks):
+        if not self.ttl:
+            return
+        expire = int(time.time() + self.ttl)
+        if not self.shared:
+            self.lists[(user_id, to_me)] = (expire, tasks)
+            return
+
+        field = self._field(to_me)
+        item = TasksCacheItem(user_id)
+        setattr(item, field, json.dumps(tasks))
+        setattr(item, field + '_expire', expire)
+        item.update(field, field + '_expire')
+
+    def invalidate(self, *user_ids):
+        for user_id in set(user_ids):
+            if not self.shared:
+                self.lists.pop((user_id, True), None)
+                self.lists.pop((user_id, False), None)
+            else:
+                TasksCacheItem(user_id).delete()
+
+
+tasks_cache = TasksCache(TASKS_CACHE_TTL, shared=bool(DYNAMODB_TABLE_CACHE))
+
+
+# DYNAMODB_TABLE_SEARCH
+# Search index structure:
+#
+# {
+#   // PRIMARY KEY
+#   "id": ID, // hash of USER_ID and a word, or of USER_ID, a word and a page
+#
+#   // word items
+#   "pages": [PAGE], // pages with tasks of the user with the word
+#
+#   // page items. PAGE is TASK_ID // SEARCH_PAGE_SIZE
+#   "task_ids": [TASK_ID], // tasks of the user with the word in description
+# }
+class SearchTokenItem(DynamodbItem):
+    INT_PARAMS = ['id']
+    TABLE = DYNAMODB_TABLE_SEARCH
+    # index is updated after the task is saved
+    UNIT_OF_WORK = False
+
+    def __init__(self, id=0):
+        self.id = id
+        self.pages = []
+        self.task_ids = []
+
+    @classmethod
+    def load_from_dict(cls, d):
+        item = super(SearchTokenItem, cls).load_from_dict(d)
+        if d.get('pages'):
+            item.pages = [int(page) for page in d['pages']['SS']]
+        if d.get('task_ids'):
+            item.task_ids = [int(task_id) for task_id in d['task_ids']['SS']]
+        return item
+
+
+class SearchIndex(object):
+    """Words of task descriptions per user.
+
+    Index is only extended: when a description is changed or the task is
+    assigned to another user, old entries are left. Found tasks are checked
+    against their current description and users instead.
+
+    Tasks of a word are split into pages by task id, so common words don't
+    grow a single item without limit. The word item lists its pages.
+    """
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+
+    @staticmethod
+    def _key(user_id, token, page=None):
+        value = '%s:%s' % (user_id, token)
+        if page is not None:
+            value += ':%s' % page
+        digest = hashlib.sha1(value.encode('utf-8')).hexdigest()
+        # fits into 64-bit integer
+        return int(digest[:15], 16)
+
+    def add(self, task_id, user_ids, description):
+        """Add the task to entries of its words. It's called once the task
+        is saved, so errors are logged rather than raised: otherwise telegram
+        would send the update again and the action would be repeated"""
+        if not self.enabled:
+            return
+        page = task_id // SEARCH_PAGE_SIZE
+        writes = []
+        for user_id in set(user_ids):
+            for token in search_tokens(description)[:SEARCH_MAX_TOKENS]:
+                writes.append((self._key(user_id, token), 'pages', page))
+                writes.append((self._key(user_id, token, page), 'task_ids', task_id))
+
+        def write(key, field, value):
+            # entries are independent, so each is written by own request
+            try:
+                storage.update_item(
+                    SearchTokenItem.TABLE, SearchTokenItem.PARTITION_KEY, SearchTokenItem.elem_to_num(key),
+                    add={field: SearchTokenItem.elem_to_array_of_str([value])},
+                )
+            except Exception:
+                logger.error('Error on adding task %s to search index', task_id, exc_info=True)
+
+        wait([write_executor.submit(write, *w) for w in writes])
+
+    def search(self, user_id, text, limit):
+        """Tasks of the user with all the words. Newest tasks first"""
+        tokens = search_tokens(text)[:SEARCH_MAX_TOKENS]
+        items = SearchTokenItem.load_by_ids([self._key(user_id, token) for token in tokens])
+        if not tokens or len(items) < len(tokens):
+            # some word is not used
+            return []
+        pages = sorted(set.intersection(*[set(item.pages) for item in items]), reverse=True)
+
+        res = []
+        for page in pages:
+            page_items = SearchTokenItem.load_by_ids([self._key(user_id, token, page) for token in tokens])
+            if len(page_items) < len(tokens):
+                continue
+            task_ids = sorted(set.intersection(*[set(item.task_ids) for item in page_items]), reverse=True)
+            # candidates may be outdated, so read a few more
+            for i in range(0, len(task_ids), limit * 2):
+                tasks = Task.load_by_ids(task_ids[i:i + limit * 2])
+                for task in sorted(tasks, key=lambda t: t.id, reverse=True):
+                    if user_id not in [task.from_id, task.to_id]:
+                        continue
+                    if not set(tokens) <= set(search_tokens(task.description)):
+                        continue
+                    res.append(task)
+                    if len(res) >= limit:
+                        return res
+        return res
+
+
+search_index = SearchIndex(enabled=bool(DYNAMODB_TABLE_SEARCH))
 # EOF
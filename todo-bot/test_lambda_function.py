@@ -0,0 +1,86 @@
+# Copyright 2020 Ivan Yelizariev <https://it-projects.info/team/yelizariev>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+"""Tests of todo-bot helpers. No AWS or telegram requests are made.
+
+    cd todo-bot
+    python3 -m unittest test_lambda_function
+"""
+import os
+import unittest
+from datetime import datetime, timedelta
+
+os.environ.setdefault('BOT_TOKEN', '123456:ABCDEFabcdef0123456789ABCDEFabcdef0')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('STORAGE', 'memory')
+os.environ.setdefault('DYNAMODB_TABLE_SEARCH', 'todo-bot-search')
+
+import lambda_function as bot  # noqa: E402
+
+
+class TestPrettyDate(unittest.TestCase):
+
+    def ago(self, **kwargs):
+        return bot.pretty_date(datetime.now() - timedelta(**kwargs))
+
+    def test_pretty_date(self):
+        self.assertEqual(self.ago(seconds=2), 'just now')
+        self.assertEqual(self.ago(seconds=437), '7 minutes ago')
+        self.assertEqual(self.ago(hours=5, minutes=3), '5 hours ago')
+        self.assertEqual(self.ago(days=1), 'Yesterday')
+        self.assertEqual(self.ago(days=3), '3 days ago')
+        self.assertEqual(self.ago(days=15), '2 weeks ago')
+        self.assertEqual(self.ago(days=100), '3 months ago')
+        self.assertEqual(self.ago(days=800), '2 years ago')
+
+    def test_pretty_date_timestamp(self):
+        self.assertEqual(bot.pretty_date(int(datetime.now().timestamp()) - 437), '7 minutes ago')
+
+
+class TestSearchIndex(unittest.TestCase):
+
+    def add_task(self, task_id, description, user_id=101):
+        task = bot.Task(task_id, user_id=user_id)
+        task.description = description
+        bot.storage.put_item(bot.Task.TABLE, bot.Task.PARTITION_KEY, task.to_dict())
+        bot.search_index.add(task_id, [user_id], description)
+
+    def test_pages(self):
+        task_ids = [bot.SEARCH_PAGE_SIZE * page + i for page in range(3) for i in range(1, 3)]
+        for task_id in task_ids:
+            self.add_task(task_id, 'Buy milk %s' % task_id)
+        self.add_task(bot.SEARCH_PAGE_SIZE * 3, 'Buy bread')
+
+        word = bot.SearchTokenItem.load_by_id(bot.search_index._key(101, 'milk'))
+        self.assertEqual(sorted(word.pages), [0, 1, 2])
+        page = bot.SearchTokenItem.load_by_id(bot.search_index._key(101, 'milk', 1))
+        self.assertEqual(sorted(page.task_ids), task_ids[2:4])
+
+        found = bot.search_index.search(101, 'buy milk', 3)
+        self.assertEqual([task.id for task in found], sorted(task_ids, reverse=True)[:3])
+        self.assertEqual(bot.search_index.search(101, 'milk bread', 3), [])
+        self.assertEqual(bot.search_index.search(102, 'milk', 3), [])
+
+
+
+class TestUnitOfWork(unittest.TestCase):
+
+    def write_tasks(self, task_ids):
+        with bot.UnitOfWork() as uow:
+            for task_id in task_ids:
+                uow.add(bot.Task.TABLE, bot.Task.PARTITION_KEY, bot.Task.elem_to_num(task_id),
+                        put={'description': bot.Task.elem_to_str('Task %s' % task_id)})
+            uow.commit()
+
+    def test_transaction_limit(self):
+        task_ids = range(1000, 1000 + bot.TRANSACT_MAX_ITEMS)
+        self.write_tasks(task_ids)
+        self.assertEqual(len(bot.Task.load_by_ids(task_ids)), bot.TRANSACT_MAX_ITEMS)
+
+        task_ids = range(2000, 2001 + bot.TRANSACT_MAX_ITEMS)
+        with self.assertRaises(bot.TooManyWrites):
+            self.write_tasks(task_ids)
+        # nothing is written
+        self.assertEqual(bot.Task.load_by_ids(task_ids), [])
+
+if __name__ == '__main__':
+    unittest.main()